@@ -6,15 +6,49 @@ Created on Thu May 28 08:20:13 2020
 aaron.b.mott@gmail.com
 """
 
-import visa
+import array
+import builtins
+import heapq
+import itertools
+import json
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+try:
+    import pyvisa as visa
+except ImportError:
+    import visa
 
 class KEI2220S():
+    """
+    Driver for the Keithley Series 2200 Programmable DC Power Supplies.
+    
+    Most of the instrument commands are generated from the _COMMANDS table
+    that follows the class; the methods written out here are those that
+    need more than validating, formatting and sending one command.
+    """
+    
+    _accumulators = ()
+    _idn = None
+    _keepalive = None
+    _rm = None
+    _channels = None
+    _dio = None
+    _read_cache = None
+    
+    # Baud rates of the serial interface and the command selecting one.
+    baud_rates = (4800, 9600, 19200, 38400, 57600, 115200)
+    baud_command = "SYST:COMM:SER:BAUD {}"
     
-    def __innit__(self,
-                  inst_address,
-                  baud_rate = 9600,
-                  term_chars = '\n',
-                  timeout = 2000):
+    def __init__(self,
+                 inst_address,
+                 baud_rate = 9600,
+                 term_chars = '\n',
+                 timeout = 2000,
+                 keepalive = None):
         """
         Initializes the instrument with instrument address, baud rate,
         termination characters, and timeout.
@@ -31,1011 +65,3168 @@ class KEI2220S():
         timeout : int, float
             Amount of time to wait for a response before a timeout error in
             milliseconds.
-        """
-        self.rm = visa.ResourceManager()
-        self.inst = self.rm.open_resource(self.instr_address,
-                                          baud_rate,
-                                          term_chars,
-                                          timeout)
-        
-    def clear_status(self):
-        """Clears all the event registers and error queue."""
-        self.inst.write("*CLS")
-        
-    def set_beep(self, boolean):
-        """
-        Turns the key beep sound on or off.
-
-        Parameters
-        ----------
-        boolean : str, int
-            The state of the beep.
-        """
-        if str(boolean).upper() in ['0', '1', 'ON', 'OFF']:
-            self.inst.write(f"CONF:SOUND {boolean}.upper()")
-        if int(boolean) in range(2):
-            self.inst.write(f"CONF:SOUND {boolean}")
-        else:
-            raise ValueError("Value Error. Please enter 0, 1, ON, or OFF.")
-        
-    def get_beep(self):
-        """Returns status of the key beep sound."""
-        beep = str(self.inst.query("CONF:SOUND?"))
-        return(beep)
-    
-    def set_ese(self, NR1):
-        """
-        Sets and queries the bits in the Event Status Enable Register.
+        keepalive : float, optional
+            Idle time in seconds after which a keep-alive query is sent. The
+            default is None, which sends none.
+        """
+        self.inst_address = inst_address
+        self.baud_rate = baud_rate
+        self.term_chars = term_chars
+        self.timeout = timeout
+        self.inst = _Link(self, self._open_resource())
+        if keepalive is not None:
+            self.start_keepalive(keepalive)
+            
+    @classmethod
+    def open(cls, serial, cache_path = None, **kwargs):
+        """
+        Opens the power supply with the given serial number. The address and
+        baud rate come from the resource cache when possible, and the cache
+        entry is checked with the *IDN? reply of the opened session. On a
+        miss or a stale entry the stale entry is removed and the resources
+        are scanned again.
 
         Parameters
         ----------
-        NR1 : int
-            Bit of the Even Status Enable Register.
-        """
-        if int(NR1) in range(256):
-            self.inst.write(f"*ESE {NR1}")
-        else:
-            raise ValueError("Value Error. Please enter an integer between 0 "
-                             "and 255.")
-        
-    def get_ese(self):
-        """Returns the bits in the Event Status Enable Register."""
-        ese = str(self.inst.query("*ESE?"))
-        return(ese)
+        serial : str
+            Serial number of the power supply.
+        cache_path : str, optional
+            Path of the resource cache. The default is None, which uses
+            ResourceDiscovery.default_cache_path.
+        **kwargs
+            Other arguments of the constructor, such as timeout.
+        """
+        discovery = ResourceDiscovery(cache_path)
+        entry = discovery.entries.get(serial)
+        if entry is not None:
+            try:
+                psu = cls(entry['address'], baud_rate=entry['baud_rate'],
+                          **kwargs)
+            except (visa.VisaIOError, OSError):
+                psu = None
+            if psu is not None:
+                try:
+                    if psu.get_idn()[2] == serial:
+                        return(psu)
+                except (visa.VisaIOError, OSError, IndexError):
+                    pass
+                psu.close()
+            discovery.forget(serial)
+        entry = discovery.scan().get(serial)
+        if entry is not None:
+            psu = cls(entry['address'], baud_rate=entry['baud_rate'],
+                      **kwargs)
+            if psu.get_idn()[2] == serial:
+                return(psu)
+            psu.close()
+            discovery.forget(serial)
+        raise ValueError("Value Error. No power supply with serial number "
+                         f"{serial} was found.")
     
-    def get_esr(self):
-        """Returns the contents of the Standard Event Status Register."""
-        esr = str(self.inst.query("*ESR"))
-        return(esr)
-
-    def get_last_curr(self):
-        """
-        Returns the last measured output current stored in the communications
-        buffer of the power supply. A new measurement is not initiated by
-        this command.
-        """
-        last_curr = str(self.inst.query("FETC:CURR?"))
-        return(last_curr)
-      
-    def get_last_volt(self):
-        """
-        Returns the last measured output voltage stored in the communications
-        buffer of the power supply. A new measurement is not initiated by
-        this command.
-        """
-        last_volt = str(self.inst.query("FETC:VOLT?"))
-        return(last_volt)   
-
-    def get_last_power(self):
+    @classmethod
+    def resource_manager(cls):
         """
-        Returns the last measured output current stored in the communications
-        buffer of the power supply. A new measurement is not initiated by
-        this command. The power calculation in the instrument is performed
-        approximately every 100 ms. Ensure that the voltage and current are
-        stable longer than this for good results.
+        Returns the VISA resource manager shared by all sessions. It is
+        created on first use.
         """
-        last_power = str(self.inst.query("FETCh:POW?"))
-        return(last_power)
+        if KEI2220S._rm is None:
+            KEI2220S._rm = visa.ResourceManager()
+        return(KEI2220S._rm)
     
-    def get_info(self):
-        """
-        Returns the power supply identification code in IEEE 488.2 notation.
-        """
-        info = str(self.inst.query("*IDN?")).split(',')
-        return(" Manufacturer: " + info[0] + '\n',
-              "Model: " + info[1] + '\n',
-              "Serial Number: " + info[2]+'\n',
-              " Firmware Version: " + info[3])
+    def _open_resource(self):
+        """Opens the VISA resource at the known address."""
+        options = {'read_termination': self.term_chars,
+                   'write_termination': self.term_chars,
+                   'timeout': self.timeout}
+        if self.inst_address.upper().startswith('ASRL'):
+            options['baud_rate'] = self.baud_rate
+        return(self.resource_manager().open_resource(self.inst_address,
+                                                     **options))
     
-    def get_model(self):
-        """Returns model number of the power supply."""
-        model = str(self.inst.query("*IDN").split(',')[1].replace(' ',''))
-        return(model)
-         
-    def get_curr(self):
-        """
-        Initiates and executes a new current measurement, and returns the
-        measured output current of the power supply.
-        """
-        curr = str(self.inst.query("MEAS:CURR?"))
-        return(curr)
+    def __enter__(self):
+        return(self)
     
-    def get_volt(self):
-        """
-        Initiates and executes a new voltage measurement, and returns the
-        measured output voltage of the power supply.
-        """
-        volt = str(self.inst.query("MEAS:VOLT?"))
-        return(volt)
- 
-    def gen_opc(self):
-        """
-        Configures the instrument to generate an operation complete message
-        by setting bit 0 of the Standard Event Status Register (SESR) when
-        all pending commands that generate an OPC message are complete.
-        """
-        self.inst.write("*OPC")
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
         
-    def get_opc(self):
+    def close(self):
         """
-        Places the ASCII character "1" into the output queue when all such
-        OPC commands are complete.
-        """
-        opc = str(self.inst.query("*OPC?"))
-        return(opc)
-      
-    def set_psc(self, NR1):
-        """
-        Sets the power-on status flag that controls the automatic
-        power-on execution of SRER and ESER. When *PSC is true, the SRER and
-        ESER are set to 0 at power-on. When *PSC is false, the current values
-        in the SRER and ESER are preserved in nonvolatile memory when power
-        is shut off and are restored at power-on.
-
-        Parameters
-        ----------
-        NR1 : int
-            Status of the automatic power-on execution.
+        Stops the keep-alive and the worker, if any, and closes the
+        resource.
         """
-        if int(NR1) in range(2):
-            self.inst.write(f"*PSC {NR1}")
-        else:
-            raise ValueError("Value Error. Please input 0 or 1.")
+        self.stop_keepalive()
+        self.stop_worker()
+        self.inst.close()
         
-    def get_psc(self):
-        """
-        Returns the power-on status flag that controls the automatic power-on
-        execution of SRER and ESER.
+    def reconnect(self):
         """
-        psc = str(self.inst.query*"*PSC?")
-        return(psc)
-     
-    def rcl(self, NR1):
+        Reopens the resource at the known address after a link failure. The
+        cached identity is kept, and the last remote or lock state set with
+        syst_remote, syst_lock or syst_local is restored.
         """
-        Restores the state of the power supply from a copy of its settings
-        stored in the setup memory. The settings are stored using the *SAV
-        command. If the specified setup memory is deleted, this command
-        causes an error.
+        self._link().reopen()
+        
+    def _link(self):
+        """Returns the _Link under any transport wrappers of the session."""
+        link = self.inst
+        while not isinstance(link, _Link):
+            if isinstance(link, _QueuedTransport):
+                link = link.worker.transport
+            else:
+                link = getattr(link, 'inst', None)
+            if link is None:
+                raise RuntimeError("Link Error. This session was not opened "
+                                   "from an address.")
+        return(link)
+        
+    def tune_link(self, trials = 20, max_error_rate = 0.0,
+                  cache_path = None):
+        """
+        Finds the fastest reliable baud rate of a serial link and switches
+        both the instrument and the host to it. The current baud rate is
+        detected first; then the round-trip latency and error rate of *OPC?
+        are measured at each supported rate. The link is measured again
+        after the switch to the chosen rate, and falls back to the last rate
+        that worked if it does not hold up. If anything fails during the
+        sweep, both ends are set back to the last rate that worked before
+        the error is raised. The chosen rate is saved in the resource cache
+        for the serial number of the power supply.
 
         Parameters
         ----------
-        NR1 : int
-            Specified memory location.
+        trials : int, optional
+            Number of *OPC? queries at each rate. The default is 20.
+        max_error_rate : float, optional
+            Highest fraction of failed queries for a rate to be reliable. The
+            default is 0.
+        cache_path : str, optional
+            Path of the resource cache. The default is None, which uses
+            ResourceDiscovery.default_cache_path.
 
         Returns
         -------
-        None.
-
-        """
-        if int(NR1) in range(41):
-            self.inst.write(f"*RCL {NR1}")
-        else:
-            raise ValueError("Value Error. Please input an integer between 0 "
-                             "and 40.")
-      
-    def reset(self):
+        dict
+            The measurements by rate, the initial and chosen rates and the
+            speed-up of the round-trip latency.
+        """
+        link = self._link()
+        if not self.inst_address.upper().startswith('ASRL'):
+            raise ValueError("Value Error. Only serial links have a baud "
+                             "rate.")
+        with link.lock:
+            initial = self._detect_baud(link.resource)
+            results = {}
+            current = initial
+            verified = True
+            try:
+                for rate in self.baud_rates:
+                    if rate != current:
+                        self._set_baud(link.resource, rate)
+                    results[rate] = self._measure_link(link.resource, trials)
+                    if results[rate]['error_rate'] >= 1:
+                        # Nothing answers at this rate, so send the
+                        # instrument back to the last rate that worked
+                        # before moving on.
+                        self._restore_baud(link.resource, current)
+                    else:
+                        current = rate
+                reliable = [rate for rate, result in results.items()
+                            if result['error_rate'] <= max_error_rate]
+                if not reliable:
+                    raise RuntimeError("Link Error. No baud rate is "
+                                       "reliable.")
+                best = min(reliable,
+                           key=lambda rate: results[rate]['latency'])
+                if best != current:
+                    self._set_baud(link.resource, best)
+                    check = self._measure_link(link.resource, trials)
+                    verified = check['error_rate'] <= max_error_rate
+            except BaseException:
+                try:
+                    self._restore_baud(link.resource, current)
+                except RuntimeError:
+                    pass
+                raise
+            if not verified:
+                self._restore_baud(link.resource, current)
+                best = current
+        self.baud_rate = best
+        discovery = ResourceDiscovery(cache_path)
+        idn = self.get_idn()
+        discovery.entries[idn[2]] = {'address': self.inst_address,
+                                     'baud_rate': best,
+                                     'model': self.get_model(),
+                                     'idn': idn}
+        discovery.save()
+        return({'initial_rate': initial,
+                'rate': best,
+                'speed_up': (results[initial]['latency'] /
+                             results[best]['latency']),
+                'results': results})
+    
+    def _set_baud(self, resource, rate):
+        """Switches the instrument, then the host, to a baud rate."""
+        resource.write(self.baud_command.format(rate))
+        resource.baud_rate = rate
+        time.sleep(0.05)
+        
+    def _restore_baud(self, resource, rate):
+        """
+        Sets both ends back to a baud rate that worked. The command is sent
+        at each rate the instrument may be listening at until it answers at
+        the restored rate.
+        """
+        rates = [resource.baud_rate] + [other for other in self.baud_rates
+                                        if other != resource.baud_rate]
+        for sent_at in rates:
+            try:
+                resource.baud_rate = sent_at
+                self._set_baud(resource, rate)
+                if self._measure_link(resource, 2)['error_rate'] < 1:
+                    return
+            except (visa.VisaIOError, OSError):
+                pass
+        resource.baud_rate = rate
+        raise RuntimeError(f"Link Error. The instrument does not answer at "
+                           f"{rate} baud.")
+        
+    def _detect_baud(self, resource):
+        """Returns the baud rate at which the instrument answers *OPC?."""
+        rates = [self.baud_rate] + [rate for rate in self.baud_rates
+                                    if rate != self.baud_rate]
+        for rate in rates:
+            resource.baud_rate = rate
+            try:
+                resource.clear()
+                if str(resource.query("*OPC?")).strip() == '1':
+                    return(rate)
+            except (visa.VisaIOError, OSError):
+                pass
+        raise RuntimeError("Link Error. The instrument does not answer at "
+                           "any baud rate.")
+        
+    @staticmethod
+    def _measure_link(resource, trials):
+        """Returns the mean latency and error rate of *OPC? queries."""
+        errors = 0
+        elapsed = 0.0
+        for _ in range(trials):
+            start = time.perf_counter()
+            try:
+                if str(resource.query("*OPC?")).strip() != '1':
+                    errors += 1
+            except (visa.VisaIOError, OSError):
+                errors += 1
+            elapsed += time.perf_counter() - start
+        answered = trials - errors
+        return({'latency': elapsed / trials if answered else float('inf'),
+                'error_rate': errors / trials})
+    
+    def start_keepalive(self, interval):
         """
-        Resets the power supply to default settings, but does not purge any
-        stored settings.
+        Starts a thread that sends *OPC? whenever the link has been idle for
+        the given interval in seconds.
         """
-        self.inst.write("*RST")
+        self.stop_keepalive()
+        self._keepalive = _KeepAlive(self._link(), interval)
+        
+    def stop_keepalive(self):
+        """Stops the keep-alive thread."""
+        if self._keepalive is not None:
+            self._keepalive.stop()
+            self._keepalive = None
         
-    def sav(self, NR1):
+    @classmethod
+    def from_transport(cls, transport):
         """
-        Saves the state of the power supply into a specified nonvolatile
-        memory location. Any settings that had been stored previously at the
-        location are overwritten. You can later use the *RCL command to
-        restore the power supply to this saved state.
+        Creates a power supply session on an already open transport without
+        opening a VISA resource, for example a RecordingTransport or a
+        ReplayTransport.
 
         Parameters
         ----------
-        NR1 : int
-            Specified nonvolatile memory location.
+        transport : object
+            Object with write and query methods like a VISA resource.
         """
-        if int(NR1) in range(1, 41):
-            self.inst.write(f"*SAV {NR1}")
-        else:
-            raise ValueError("Value Error. Please eneter an integer between 1"
-                              " and 41.")
+        psu = cls.__new__(cls)
+        psu.inst = transport
+        return(psu)
     
-    def set_curr(self, NRf, unit = 'A'):
-        """Sets the current value of the power supply in units of A or mA."""
-        if unit.upper() == 'MA' and float(NRf): #Converts mA to A
-            NRf = float(NRf) / 1000
-        if self.get_model() == '2200-72-1' and 0 <= float(NRf) <= 1.2:
-            self.inst.write(f"CURR {NRf}A")
-        if (self.get_model() in ['2220-30-1', '2220G-30-1'] and
-                                0 <= float(NRf) <= 1.5):
-            self.inst.write(f"CURR {NRf}A")
-        if self.get_model() == '2200-60-2' and 0 <= float(NRf) <= 2.5:
-            self.inst.write(f"CURR {NRf}A")
-        if (self.get_model() in ['2200-32-3', '2231A-30-3'] and
-                                0 <= float(NRf) <= 3):
-            self.inst.write(f"CURR {NRf}A")
-        if (self.get_model() in ['2200-20-5', '2200-30-5', '2230-30-1',
-                                 '2230G-30-1'] and 0 <= float(NRf) <= 5):
-            self.inst.write(f"CURR {NRf}A")
-        else:
-            raise ValueError("Value Error. Please refer to the manual for "
-                             "correct parameters.")
+    def get_last_sample(self):
+        """
+        Returns the last measured output voltage and current in a single
+        query, together with the host time at which they were read. The
+        sample is also fed to every attached accumulator.
 
-    def set_curr_max(self):
-        """Sets the currentl value of the power supply to its maximum value."""
-        self.inst.write("CURR MAX")
-        
-    def set_curr_min(self):
-        """Sets the currentl value of the power supply to its minimum value."""
-        self.inst.write("CURR MIN")
-        
-    def set_curr_def(self):
-        """Sets the currentl value of the power supply to its default value."""
-        self.inst.write("CURR DEF")
-        
-    def get_curr_setting(self):
-        """Returns the current value of the power supply."""
-        curr_setting = str(self.inst.query("CURR?"))
-        return(curr_setting)
-     
-    def set_ttl(self, NR1):
+        Returns
+        -------
+        tuple
+            (timestamp in s, voltage in V, current in A).
+        """
+        reply = str(self.inst.query("FETC:VOLT?;:FETC:CURR?")).split(';')
+        sample = (time.perf_counter(), float(reply[0]), float(reply[1]))
+        for accumulator in self._accumulators:
+            accumulator.add(*sample)
+        return(sample)
+    
+    def capture(self, duration = None, samples = None, interval = 0,
+                capture = None):
         """
-        Sets the output state of the rear-panel TTL control output the state
-        of the rear-panel TTL control input. When the port mode is DIGITAL,
-        this command is enabled. 
+        Acquires the last measured voltage, current and power together with
+        the questionable condition register into a columnar Capture. Each
+        sample is read with a single query.
 
         Parameters
         ----------
-        NR1 : int
-            Output state.
-        """
-        if int(NR1) in range(2):
-            self.inst.write(f"DIG:DATA {NR1}")
-        else:
-            raise ValueError("Value Error. Please enter 0 for low state or 1 "
-                             "for high state.")
-        
-    def get_ttl(self):
-        """Returns output state of the rear-panel TTL."""
-        ttl = str(self.inst.query("DIG:DATA?"))
-        return(ttl)
+        duration : float, optional
+            Length of the acquisition in seconds.
+        samples : int, optional
+            Number of samples to acquire. At least one of duration and
+            samples must be given.
+        interval : float, optional
+            Minimum time between samples in seconds. The default is 0, which
+            samples as fast as the link allows.
+        capture : Capture, optional
+            Capture to append to. The default is None, which creates a new
+            one.
+
+        Returns
+        -------
+        Capture
+            The capture holding the acquired samples.
+        """
+        if duration is None and samples is None:
+            raise ValueError("Value Error. Please enter a duration or a "
+                             "number of samples.")
+        if capture is None:
+            capture = Capture()
+        query = self.inst.query
+        append = capture.append
+        accumulators = self._accumulators
+        count = 0
+        start = time.perf_counter()
+        end = start + duration if duration is not None else float('inf')
+        next_time = start
+        while samples is None or count < samples:
+            now = time.perf_counter()
+            if now >= end:
+                break
+            if now < next_time:
+                time.sleep(next_time - now)
+            next_time += interval
+            reply = query("FETC:VOLT?;:FETC:CURR?;:FETC:POW?;"
+                          ":STAT:QUES:COND?").split(';')
+            stamp = time.perf_counter()
+            volt = float(reply[0])
+            curr = float(reply[1])
+            append(stamp, volt, curr, float(reply[2]), int(reply[3]))
+            for accumulator in accumulators:
+                accumulator.add(stamp, volt, curr)
+            count += 1
+        return(capture)
     
-    def set_dig_func(self, string):
+    def capture_step(self, action, duration, quantity = 'volt',
+                     band = 0.02):
         """
-        Sets the function of the TTL control lines on the rear panel of the
-        power supply.
+        Issues an action and immediately samples the output as fast as the
+        link allows, then computes the step response of the output.
 
         Parameters
         ----------
-        string : str
-            Function of the TTL control.
-        """
-        if str(string).upper() in ['TRIG', ' TRIGGER', 'RIDFI', 'RIDF', 'DIG',
-                                   'DIGITAL']:
-            self.inst.write(f"DIGI:FUNC {string}.upper()")
-        else:
-            raise ValueError("Value Error. Please enter TRIG, RIDF, or DIG.")
-  
-    def get_dig_func(self):
-        """
-        Returns the function of the TTL control lines on the rear panel of the
-        power supply.
-        """
-        dig_func = str(self.inst.query("DIGI:FUNC?"))
-        return(dig_func)
+        action : callable or str
+            Either a function called with no arguments, for example
+            lambda: psu.set_volt(5), or a SCPI command string to write.
+        duration : float
+            Length of the acquisition after the action in seconds.
+        quantity : str, optional
+            Output quantity to analyse, 'volt' or 'curr'. The default is
+            'volt'.
+        band : float, optional
+            Settling band as a fraction of the step size. The default is
+            0.02.
 
-    def set_func_mode(self, string):
+        Returns
+        -------
+        StepResponse
+            The samples and the rise time, overshoot and settling time.
+        """
+        if quantity not in ['volt', 'curr']:
+            raise ValueError("Value Error. Please enter volt or curr.")
+        # A SCPI instrument discards a reply when a new query arrives before
+        # it is read, so queries cannot be overlapped; the loop instead keeps
+        # everything but the exchange itself out of the sampling path.
+        query = self.inst.query
+        clock = time.perf_counter
+        message = "FETC:VOLT?;:FETC:CURR?"
+        before = query(message).split(';')
+        initial = float(before[0 if quantity == 'volt' else 1])
+        capture = Capture()
+        append = capture.append
+        if isinstance(action, str):
+            self.inst.write(action)
+        else:
+            action()
+        start = clock()
+        end = start + duration
+        sent = start
+        while sent < end:
+            reply = query(message)
+            received = clock()
+            volt, curr = reply.split(';')
+            volt = float(volt)
+            curr = float(curr)
+            append(0.5 * (sent + received), volt, curr, volt * curr)
+            sent = received
+        return(StepResponse(capture, start, initial, quantity, band))
+    
+    def attach_accumulator(self, accumulator):
         """
-        Can be in either fixed mode or list mode. When this command is in
-        fixed mode, the power supply responds to discrete commands. When this
-        command is in list mode, the power supply operates in list mode.
+        Attaches an accumulator to the measurement stream. Every sample read
+        with get_last_sample is added to it.
 
         Parameters
         ----------
-        string : str
-            Mode of the power supply.
+        accumulator : PowerAccumulator
+            Accumulator to feed.
         """
-        if str(string).upper() in ['FIX', 'FIXED', 'LIST']:
-            self.inst.write(f"FUNC:MODE {string}.upper()")
-        else:
-            raise ValueError("Value Error. Please enter FIX or LIST.")
-        
-    def get_func_mode(self):
-        """Returns mode of the power supply."""
-        func_mode = str(self.inst.query("FUNC:MODE?"))
-        return(func_mode)
+        self._accumulators = self._accumulators + (accumulator,)
         
-    def set_list_count(self, NR1):
+    def detach_accumulator(self, accumulator):
+        """Detaches an accumulator from the measurement stream."""
+        self._accumulators = tuple(acc for acc in self._accumulators
+                                   if acc is not accumulator)
+    
+    def start_worker(self):
         """
-        Configures the number of times the active list will execute before
-        stopping.
+        Makes the session thread-safe. A SessionWorker thread takes over the
+        transport and every write and query of the driver, from any thread,
+        goes through its priority queue.
 
-        Parameters
-        ----------
-        NR1 : int
-            Number of times the list will execute before stopping.
+        Returns
+        -------
+        SessionWorker
+            The worker owning the transport.
+        """
+        if isinstance(self.inst, _QueuedTransport):
+            return(self.inst.worker)
+        worker = SessionWorker(self.inst)
+        self.inst = _QueuedTransport(worker)
+        return(worker)
+    
+    def stop_worker(self):
         """
-        if int(NR1) in range(2, 65536):
-            self.inst.write(f"LIST:COUN {NR1}")
-        else:
-            raise ValueError("Value Error. Please enter an integer between 2 "
-                             "and 65535.")
-        
-    def set_curr_step(self, NR1, NRf, unit = 'A'):
+        Processes the commands still queued, stops the worker and gives the
+        transport back to the session.
+        """
+        if isinstance(self.inst, _QueuedTransport):
+            worker = self.inst.worker
+            worker.stop()
+            self.inst = worker.transport
+            
+    def submit(self, name, *args, priority = None, **kwargs):
         """
-        Sets the current for a list step in units of A or mA.
+        Queues a driver command on the session worker without waiting for it.
 
         Parameters
         ----------
-        NR1 : int
-            Step number in the active list.
-        NRf : float
-            Current rating in amperes.
-        unit : str, optional
-            Unit of current. The default is 'A'.
-        """
-        if str(unit).upper() == 'MA' and float(NRf):
-            NRf = float(NRf) / 1000
-        if int(NR1) in range(1, 81):
-            if self.get_model() == '2200-72-1' and 0 <= float(NRf) <= 1.2:
-                self.inst.write(f"LIST:CURR {NR1}, {NRf}A")
-            if (self.get_model() in ['2220-30-1', '2220G-30-1'] and
-                                    0 <= float(NRf) <= 1.5):
-                self.inst.write(f"LIST:CURR {NR1}, {NRf}A")
-            if self.get_model() == '2200-60-2' and 0 <= float(NRf) <= 2.5:
-                self.inst.write(f"LIST:CURR {NR1}, {NRf}A")
-            if (self.get_model() in ['2200-32-3', '2231A-30-3'] and
-                                    0 <= float(NRf) <= 3):
-                self.inst.write(f"LIST:CURR {NR1}, {NRf}A")
-            if (self.get_model() in ['2200-20-5', '2200-30-5', '2230-30-1',
-                                     '2230G-30-1'] and 0 <= float(NRf) <= 5):
-                self.inst.write(f"LIST:CURR {NR1}, {NRf}A")
-        else:
-            raise ValueError("Value Error. Please refer to the manual for "
-                             "correct parameters.")
-        
-    def get_curr_step(self, NR1):
+        name : str
+            Name of the driver method, for example 'set_curr' or 'get_volt'.
+        *args, **kwargs
+            Arguments of the driver method. They are validated before the
+            command is queued.
+        priority : int, optional
+            One of the SessionWorker priorities. The default is None, which
+            picks the priority from the command.
+
+        Returns
+        -------
+        Future
+            Resolves to the parsed reply of a query, or to None for a write.
+        """
+        if not isinstance(self.inst, _QueuedTransport):
+            raise RuntimeError("Worker Error. Please call start_worker "
+                               "first.")
+        command = self.commands[name]
+        message = command.encode(self, *args, **kwargs)
+        return(self.inst.worker.submit(message, command.query, priority,
+                                       command.parser))
+    
+    @property
+    def ch(self):
+        """
+        Returns the outputs of a multi-output model as a dictionary of
+        Channel objects by channel number, starting at 1. Every Channel
+        operation selects channel 1 again when it is done, so the other
+        commands of the session, and the Regulator, ReadCache, capture and
+        TestPlan built on them, act on channel 1, which the instrument
+        selects at power-on, and are checked against its limits.
+        """
+        if self._channels is None:
+            limits = _CHANNELS.get(self.get_model())
+            if limits is None:
+                raise ValueError(f"Value Error. The {self.get_model()} has a "
+                                 "single output.")
+            self._channels = {number: Channel(self, number, volt, curr)
+                              for number, (volt, curr) in
+                              enumerate(limits, 1)}
+        return(self._channels)
+    
+    @property
+    def dio(self):
+        """Returns the DigitalIO subsystem of the rear-panel TTL port."""
+        if self._dio is None:
+            self._dio = DigitalIO(self)
+        return(self._dio)
+    
+    def apply_channels(self, settings):
         """
-        Returns the current level for a specific step.
+        Sets the voltage and current of several outputs in one message.
 
         Parameters
         ----------
-        NR1 : int
-            Step to be selected.
+        settings : dict
+            (voltage in V, current in A) by channel number.
         """
-        if int(NR1) in range(1, 81):
-            curr_step = str(self.inst.query("LIST:CURR? " + str(NR1)))
-            return(curr_step)
-        else:
-            raise ValueError("Value Error. Please enter an integer between 1 "
-                             "and 80.")
+        messages = []
+        for number, (volt, curr) in settings.items():
+            messages.append(self.ch[number].encode_apply(volt, curr))
+        self.inst.write(_join(messages + ["INST:NSEL 1"]))
         
-    def set_list_mode(self, string):
+    def measure_all_channels(self):
+        """
+        Returns the last measured voltage and current of every output, read
+        in one exchange, as a dictionary of (voltage, current) by channel
+        number.
+        """
+        channels = self.ch
+        volts, currs = str(self.inst.query("FETC:VOLT:ALL?;"
+                                           ":FETC:CURR:ALL?")).split(';')
+        volts = [float(volt) for volt in volts.split(',')]
+        currs = [float(curr) for curr in currs.split(',')]
+        return({number: (volts[number - 1], currs[number - 1])
+                for number in channels})
+    
+    def plan(self, latency = None):
         """
-        Determines the response of the power supply to a trigger in listmode.
+        Returns a TestPlan recording driver operations for this session.
 
         Parameters
         ----------
-        string : str
-            Power supply response.
+        latency : LatencyModel, optional
+            Model used to estimate the duration of the plan. The default is
+            None, which uses a LatencyModel for the baud rate of the session.
         """
-        if str(string).upper() in ['CONT', 'CONTINUED', 'STEP']:
-            self.inst.write("LIST:MODE " + str(string))
-        else:
-            return("Input error. Please enter CONT or STEP.")
-        
-    def get_list_mode(self):
-        """
-        Returns the the response of the power supply to a trigger in listmode.
-        """
-        list_mode = str(self.inst.query("LIST:MODE?"))
-        return(list_mode)
+        return(TestPlan(self, latency))
     
-    def recall_list(self, NR1):
+    def enable_read_cache(self, max_age = None):
         """
-        Recalls a previously saved list from the specified storage location and
-        makes it the active list for editing or execution.
+        Answers get_last_volt, get_last_curr and get_last_power from a
+        ReadCache while their values are fresh enough.
 
         Parameters
         ----------
-        NR1 : int
-            Specified storage location.
+        max_age : dict, optional
+            Maximum age in seconds by quantity ('volt', 'curr', 'power').
+            The default is None, which uses the update period of the
+            instrument, about 100 ms.
+
+        Returns
+        -------
+        ReadCache
+            The cache of the session.
         """
-        if int(NR1) in range(1, 9):
-            self.inst.write(f"LIST:RCL {NR1}")
-        else:
-            raise ValueError("Value Error. Please enter an integer between 1 "
-                             "and 8.")
+        self._read_cache = ReadCache(self, max_age)
+        return(self._read_cache)
+    
+    def disable_read_cache(self):
+        """Sends every measurement read to the instrument again."""
+        self._read_cache = None
         
-    def save_list(self, NR1):
+    def get_idn(self):
         """
-        Saves the active list file to a storage location in nonvolatile
-        memory.
-
-        Parameters
-        ----------
-        NR1 : int
-            Storage location.
+        Returns the identification fields of the power supply as a list of
+        manufacturer, model, serial number and firmware version. The reply
+        is queried once and cached for the session.
         """
-        if int(NR1) in range(1, 9):
-            self.inst.write(f"LIST:SAV {NR1}")
-        else:
-            raise ValueError("Value Error. Please enter an integer between 1 "
-                             "and 8.")
-  
-    def set_steps(self, NR1):
+        if self._idn is None:
+            self._idn = [field.strip() for field in
+                         str(self.inst.query("*IDN?")).split(',')]
+        return(self._idn)
+    
+    def get_info(self):
         """
-        Configures the number of steps in the active list. The number of
-        steps must be configured before loading the voltage levels, current
-        levels, and/or durations of the steps.
-
-        Parameters
-        ----------
-        NR1 : str, int
-            Number of steps in the active list.
+        Returns the power supply identification code in IEEE 488.2 notation.
         """
-        if str(NR1).upper() in ['MIN', 'MAX']:
-            self.inst.write(f"LIST:STEP {NR1}.upper()")
-        if int(NR1) in range(2, 81):
-            self.inst.write(f"LIST:STEP {NR1}")
-        else:
-            raise ValueError("Value Error. Please enter an integer between 2 "
-                             "and 80, or MIN or MAX.")
+        info = self.get_idn()
+        return(" Manufacturer: " + info[0] + '\n',
+              "Model: " + info[1] + '\n',
+              "Serial Number: " + info[2]+'\n',
+              " Firmware Version: " + info[3])
+    
+    def get_model(self):
+        """Returns model number of the power supply."""
+        model = self.get_idn()[1].replace(' ','')
+        return(model)
+    
+    def get_limits(self):
+        """
+        Returns the maximum programmable voltage in V and current in A of the
+        power supply model. On multi-output models these are the limits of
+        channel 1, the output the commands of the session act on.
+        """
+        if self.get_model() in _CHANNELS:
+            return(_CHANNELS[self.get_model()][0])
+        try:
+            return(_MODELS[self.get_model()])
+        except KeyError:
+            raise ValueError("Value Error. Unknown model "
+                             f"{self.get_model()}.") from None
+
+
+# Maximum output voltage in V and current in A of each model.
+_MODELS = {'2200-20-5': (20, 5),
+           '2200-30-5': (30, 5),
+           '2200-32-3': (32, 3),
+           '2200-60-2': (60, 2.5),
+           '2200-72-1': (72, 1.2),
+           '2220-30-1': (30, 1.5),
+           '2220G-30-1': (30, 1.5),
+           '2230-30-1': (30, 5),
+           '2230G-30-1': (30, 5),
+           '2231A-30-3': (30, 3)}
+
+# Maximum voltage in V and current in A of each output of the multi-output
+# models, from channel 1 up.
+_CHANNELS = {'2220-30-1': ((30, 1.5), (30, 1.5)),
+             '2220G-30-1': ((30, 1.5), (30, 1.5)),
+             '2230-30-1': ((30, 1.5), (30, 1.5), (6, 5)),
+             '2230G-30-1': ((30, 1.5), (30, 1.5), (6, 5)),
+             '2231A-30-3': ((30, 3), (30, 3), (5, 3))}
+
+
+def _alternatives(items):
+    """Returns a list of items as English text, like 'A, B, or C'."""
+    items = [str(item) for item in items]
+    if len(items) < 3:
+        return(" or ".join(items))
+    return(", ".join(items[:-1]) + ", or " + items[-1])
+
+
+class _Int():
+    """Integer argument within a range, or one of a set of keywords."""
+    
+    def __init__(self, low, high, doc, name = 'NR1', extra = (),
+                 keywords = ()):
+        self.values = frozenset(range(low, high + 1)) | frozenset(extra)
+        self.keywords = frozenset(keywords)
+        self.names = (name,)
+        self.params = (name,)
+        self.doc = (f"{name} : {'str, int' if keywords else 'int'}\n"
+                    f"    {doc}")
+        choices = _alternatives([f"an integer between {low} and {high}",
+                                 *extra, *keywords])
+        self.message = f"Value Error. Please enter {choices}."
         
-    def set_volt_step(self, NR1, NRf, unit = 'V'):
-        """
-        Sets the voltage level of a specified step in a list in units of V
-        or mV.  
+    def convert(self, psu, value):
+        if self.keywords and str(value).upper() in self.keywords:
+            return(str(value).upper())
+        try:
+            if int(value) in self.values:
+                return(str(int(value)))
+        except (TypeError, ValueError):
+            pass
+        raise ValueError(self.message)
 
-        Parameters
-        ----------
-        NR1 : int
-            Step number in active list.
-        NRf : float
-            Voltage from the step.
-        unit : str, optional
-            Unit of voltage. The default is 'V'.
-        """
-        if str(unit).upper == 'MV' and float(NRf):
-            NRf = float(NRf) / 1000
-        if int(NR1) in range(1, 81):
-            if self.get_model == '2200-20-5' and 0 <= float(NRf) <= 20:
-                self.inst.write(f"LIST:VOLT {NR1}, {NRf}V")
-            if (self.get_model() in ['2200-30-5', '2230G-30-1', '2230-30-1',
-                                    '2220G-30-1', '2220-30-1', '2231A-30-3']
-                                    and 0 <= float(NRf) <= 30):
-                                        self.inst.write(f"LIST:VOLT {NR1}, "
-                                                        "{NRf}V")
-            if self.get_model() == '2200-32-3' and 0 <= float(NRf) <= 32:
-                self.inst.write(f"LIST:VOLT {NR1}, {NRf}V")
-            if self.get_model() == '2200-60-2' and 0 <= float(NRf) <= 60:
-                self.inst.write(f"LIST:VOLT {NR1}, {NRf}V")
-            if self.get_model() == '2200-72-1' and 0 <= float(NRf) <= 72:
-                self.inst.write(f"LIST:VOLT {NR1}, {NRf}V")
-        else:
-            raise ValueError("Value Error. Please refer to the manual for "
-                             "correct parameters.")
+
+class _Choice():
+    """String argument from a fixed set of mnemonics."""
+    
+    def __init__(self, choices, doc, name = 'string'):
+        self.choices = frozenset(choices)
+        self.names = (name,)
+        self.params = (name,)
+        self.doc = f"{name} : str\n    {doc}"
+        self.message = ("Value Error. Please enter " +
+                        _alternatives(choices) + ".")
         
-    def set_step_duration(self, NR1, NRf, unit = 'ms'):
-        """
-        Sets the duration of a specified step in a list.
+    def convert(self, psu, value):
+        value = str(value).upper()
+        if value in self.choices:
+            return(value)
+        raise ValueError(self.message)
 
-        Parameters
-        ----------
-        NR1 : str, int
-            Step in active list.
-        NRf : float
-            Duration of the step.
-        unit : str, optional
-            Unit of time. The default is 'ms'.
-        """
-        if str(unit).lower() == 's' and float(NRf):
-            NRf = float(NRf) * 1000
-        if str(NR1).upper() in ['MIN', 'MAX'] and 0 <= NRf:
-            self.inst.write(f"LIST:WIDTH {NR1}.upper(), {NRf}ms")
-        if int(NR1) in range(1, 81) and 0 <= NRf:
-            self.inst.write(f"LIST:WIDTH {NR1}, {NRf}ms")
+
+class _Bool(_Choice):
+    """Boolean argument given as a bool, 0, 1, ON or OFF."""
+    
+    def __init__(self, doc, name = 'boolean'):
+        super().__init__(['0', '1', 'ON', 'OFF'], doc, name)
+        self.doc = f"{name} : bool, str, int\n    {doc}"
+        
+    def convert(self, psu, value):
+        if value is True or value is False:
+            return(str(int(value)))
+        return(super().convert(psu, value))
+
+
+class _Real():
+    """
+    Real argument with a unit, checked against a fixed range or against the
+    voltage or current limit of the power supply model.
+    """
+    
+    def __init__(self, limit, units, doc, suffix = '', keywords = (),
+                 name = 'NRf'):
+        self.limit = limit
+        self.units = {unit.upper(): scale for unit, scale in units.items()}
+        self.suffix = suffix
+        self.keywords = frozenset(keywords)
+        self.unit_names = tuple(units)
+        default = self.unit_names[0]
+        self.names = (name, 'unit')
+        self.params = (name, f"unit = '{default}'")
+        self.doc = (f"{name} : {'str, float' if keywords else 'float'}\n"
+                    f"    {doc}\n"
+                    "unit : str, optional\n"
+                    f"    Unit of the value. The default is '{default}', but "
+                    "may be set to " + _alternatives(units) + ".")
+        self.keyword_names = tuple(keywords)
+        
+    def convert(self, psu, value, unit):
+        if self.keywords and str(value).upper() in self.keywords:
+            return(str(value).upper())
+        try:
+            scale = self.units[str(unit).upper()]
+        except KeyError:
+            raise ValueError("Value Error. Please enter a unit of " +
+                             _alternatives(self.unit_names) + ".") from None
+        value = float(value) * scale
+        if self.limit == 'volt':
+            low, high = 0, psu.get_limits()[0]
+        elif self.limit == 'curr':
+            low, high = 0, psu.get_limits()[1]
         else:
-            return("Input error. Please refer to the manual for correct "
-                   "parameters.")
+            low, high = self.limit
+        if not low <= value <= high:
+            choices = _alternatives([f"a value between {low:g} and "
+                                     f"{high:g}", *self.keyword_names])
+            raise ValueError(f"Value Error. Please enter {choices}.")
+        return(f"{value:.10g}{self.suffix}")
+
+
+class _Command():
+    """
+    One entry of the command table. The entry generates the encoder that
+    validates the arguments and formats the SCPI message, and the driver
+    method that sends it.
+    """
+    
+    def __init__(self, name, template, doc, *args, query = False,
+                 parser = str, cache_key = None):
+        self.name = name
+        self.template = template
+        self.args = args
+        self.query = query
+        self.parser = parser
+        self.cache_key = cache_key
+        self.doc = doc
+        if args:
+            self.doc += "\n\nParameters\n----------\n"
+            self.doc += "\n".join(arg.doc for arg in args)
+        self.encode = self._compile()
+        
+    def _compile(self):
+        """
+        Compiles the encoder. Its signature is that of the driver method,
+        and it returns the SCPI message for the given arguments.
+        """
+        if not self.args:
+            message = self.template
+            return(lambda psu: message)
+        namespace = {'_format': self.template.format}
+        params = ['psu']
+        values = []
+        for index, arg in enumerate(self.args):
+            namespace[f'_arg{index}'] = arg.convert
+            params.extend(arg.params)
+            values.append(f"_arg{index}(psu, {', '.join(arg.names)})")
+        exec(f"def encode({', '.join(params)}):\n"
+             f"    return(_format({', '.join(values)}))\n", namespace)
+        return(namespace['encode'])
+    
+    def method(self):
+        """Returns the driver method for this command."""
+        namespace = {'_encode': self.encode, '_parse': self.parser}
+        params = ['self']
+        names = ['self']
+        for arg in self.args:
+            params.extend(arg.params)
+            names.extend(arg.names)
+        call = f"_encode({', '.join(names)})"
+        if self.query:
+            body = f"return(_parse(self.inst.query({call})))"
+        else:
+            body = f"self.inst.write({call})"
+        if self.cache_key is not None:
+            # Answered from the read cache when the session has one.
+            body = ("if self._read_cache is not None:\n"
+                    "        return(_parse(self._read_cache.reply("
+                    f"'{self.cache_key}')))\n    " + body)
+        exec(f"def {self.name}({', '.join(params)}):\n    {body}\n",
+             namespace)
+        method = namespace[self.name]
+        method.__doc__ = self.doc
+        return(method)
+
+
+def _install_commands(cls, commands):
+    """Generates the driver methods of a command table on a class."""
+    cls.commands = {}
+    for command in commands:
+        method = command.method()
+        method.__qualname__ = f"{cls.__name__}.{command.name}"
+        cls.commands[command.name] = command
+        setattr(cls, command.name, method)
+
+
+_VOLT_UNITS = {'V': 1, 'mV': 0.001, 'kV': 1000}
+_CURR_UNITS = {'A': 1, 'mA': 0.001}
+_LEVELS = ('MIN', 'MAX', 'DEF')
+
+_COMMANDS = [
+    # IEEE 488.2 common commands
+    _Command('clear_status', "*CLS",
+             "Clears all the event registers and error queue."),
+    _Command('set_ese', "*ESE {}",
+             "Sets the bits in the Event Status Enable Register.",
+             _Int(0, 255, "Bit of the Event Status Enable Register.")),
+    _Command('get_ese', "*ESE?",
+             "Returns the bits in the Event Status Enable Register.",
+             query = True),
+    _Command('get_esr', "*ESR?",
+             "Returns the contents of the Standard Event Status Register.",
+             query = True),
+    _Command('gen_opc', "*OPC",
+             "Configures the instrument to generate an operation complete "
+             "message\nby setting bit 0 of the Standard Event Status Register "
+             "(SESR) when\nall pending commands that generate an OPC message "
+             "are complete."),
+    _Command('get_opc', "*OPC?",
+             "Places the ASCII character \"1\" into the output queue when all "
+             "such\nOPC commands are complete.", query = True),
+    _Command('set_psc', "*PSC {}",
+             "Sets the power-on status flag that controls the automatic\n"
+             "power-on execution of SRER and ESER. When *PSC is true, the "
+             "SRER and\nESER are set to 0 at power-on. When *PSC is false, "
+             "the current values\nin the SRER and ESER are preserved in "
+             "nonvolatile memory when power\nis shut off and are restored at "
+             "power-on.",
+             _Int(0, 1, "Status of the automatic power-on execution.")),
+    _Command('get_psc', "*PSC?",
+             "Returns the power-on status flag that controls the automatic "
+             "power-on\nexecution of SRER and ESER.", query = True),
+    _Command('rcl', "*RCL {}",
+             "Restores the state of the power supply from a copy of its "
+             "settings\nstored in the setup memory. The settings are stored "
+             "using the *SAV\ncommand. If the specified setup memory is "
+             "deleted, this command\ncauses an error.",
+             _Int(0, 40, "Specified memory location.")),
+    _Command('reset', "*RST",
+             "Resets the power supply to default settings, but does not purge "
+             "any\nstored settings."),
+    _Command('sav', "*SAV {}",
+             "Saves the state of the power supply into a specified "
+             "nonvolatile\nmemory location. Any settings that had been stored "
+             "previously at the\nlocation are overwritten. You can later use "
+             "the *RCL command to\nrestore the power supply to this saved "
+             "state.",
+             _Int(1, 40, "Specified nonvolatile memory location.")),
+    _Command('set_sre', "*SRE {}",
+             "Sets the bits in the service request enable register (SRER).",
+             _Int(0, 255, "Bit of the SRER.")),
+    _Command('get_sre', "*SRE?",
+             "Returns the bits of the service request enable register "
+             "(SRER).", query = True),
+    _Command('get_sbr', "*STB?",
+             "Returns the contents of the status byte register (SBR) using "
+             "the Master\nSummary Status (MSS) bit.", query = True),
+    _Command('trigger', "*TRG", "Generates a trigger event."),
+    _Command('get_test', "*TST?",
+             "Initiates a self-test and reports any errors.", query = True),
+    _Command('wait', "*WAI",
+             "Prevents the instrument from executing further\ncommands or "
+             "queries until all pending commands are complete."),
+    
+    # Front panel
+    _Command('set_beep', "CONF:SOUND {}",
+             "Turns the key beep sound on or off.",
+             _Bool("The state of the beep.")),
+    _Command('get_beep', "CONF:SOUND?",
+             "Returns status of the key beep sound.", query = True),
+    
+    # Measurements
+    _Command('get_last_curr', "FETC:CURR?",
+             "Returns the last measured output current stored in the "
+             "communications\nbuffer of the power supply. A new measurement "
+             "is not initiated by\nthis command.", query = True,
+             cache_key = 'curr'),
+    _Command('get_last_volt', "FETC:VOLT?",
+             "Returns the last measured output voltage stored in the "
+             "communications\nbuffer of the power supply. A new measurement "
+             "is not initiated by\nthis command.", query = True,
+             cache_key = 'volt'),
+    _Command('get_last_power', "FETC:POW?",
+             "Returns the last measured output power stored in the "
+             "communications\nbuffer of the power supply. A new measurement "
+             "is not initiated by\nthis command. The power calculation in "
+             "the instrument is performed\napproximately every 100 ms. "
+             "Ensure that the voltage and current are\nstable longer than "
+             "this for good results.", query = True, cache_key = 'power'),
+    _Command('get_curr', "MEAS:CURR?",
+             "Initiates and executes a new current measurement, and returns "
+             "the\nmeasured output current of the power supply.",
+             query = True),
+    _Command('get_volt', "MEAS:VOLT?",
+             "Initiates and executes a new voltage measurement, and returns "
+             "the\nmeasured output voltage of the power supply.",
+             query = True),
+    
+    # Current
+    _Command('set_curr', "CURR {}",
+             "Sets the current value of the power supply in units of A or "
+             "mA.",
+             _Real('curr', _CURR_UNITS, "Current value.", suffix = 'A')),
+    _Command('set_curr_max', "CURR MAX",
+             "Sets the current value of the power supply to its maximum "
+             "value."),
+    _Command('set_curr_min', "CURR MIN",
+             "Sets the current value of the power supply to its minimum "
+             "value."),
+    _Command('set_curr_def', "CURR DEF",
+             "Sets the current value of the power supply to its default "
+             "value."),
+    _Command('get_curr_setting', "CURR?",
+             "Returns the current value of the power supply.", query = True),
+    
+    # Digital I/O
+    _Command('set_ttl', "DIG:DATA {}",
+             "Sets the output state of the rear-panel TTL control output. "
+             "When the port\nmode is DIGITAL, this command is enabled.",
+             _Int(0, 1, "Output state, 0 for low or 1 for high.")),
+    _Command('get_ttl', "DIG:DATA?",
+             "Returns output state of the rear-panel TTL.", query = True),
+    _Command('set_dig_func', "DIG:FUNC {}",
+             "Sets the function of the TTL control lines on the rear panel of "
+             "the\npower supply.",
+             _Choice(['TRIG', 'TRIGGER', 'RIDF', 'RIDFI', 'DIG', 'DIGITAL'],
+                     "Function of the TTL control.")),
+    _Command('get_dig_func', "DIG:FUNC?",
+             "Returns the function of the TTL control lines on the rear panel "
+             "of the\npower supply.", query = True),
+    _Command('set_dfi_output', "OUTP:DFI:SOUR {}",
+             "Associates the DFI TTL output on the rear panel with a "
+             "specified bit\nin the status byte register (SBR). Once the bit "
+             "is associated with\nthe DFI signal, the DFI signal will reflect "
+             "the state of the\nspecified bit. The port needs to be in the "
+             "DFI or RI mode before\nusing this command.",
+             _Choice(['OFF', 'QUES', 'OPER', 'ESB', 'RQS'],
+                     "Source bit of the DFI output.")),
+    _Command('get_dfi_output', "OUTP:DFI:SOUR?",
+             "Returns the DFI TTL output associated with a specific bit in "
+             "the\nstatus byte register (SBR).", query = True),
+    _Command('set_ri_pin', "OUTP:RI:MODE {}",
+             "Sets the input mode of the RI (remote inhibit) input pin.",
+             _Choice(['OFF', 'LATC', 'LATCHING', 'LIVE'], "Input mode.")),
+    _Command('get_ri_pin', "OUTP:RI:MODE?",
+             "Returns the input mode of the RI (remote inhibit) input pin.",
+             query = True),
+    
+    # List mode
+    _Command('set_func_mode', "FUNC:MODE {}",
+             "Can be in either fixed mode or list mode. When this command is "
+             "in\nfixed mode, the power supply responds to discrete commands. "
+             "When this\ncommand is in list mode, the power supply operates "
+             "in list mode.",
+             _Choice(['FIX', 'FIXED', 'LIST'], "Mode of the power supply.")),
+    _Command('get_func_mode', "FUNC:MODE?",
+             "Returns mode of the power supply.", query = True),
+    _Command('set_list_count', "LIST:COUN {}",
+             "Configures the number of times the active list will execute "
+             "before\nstopping.",
+             _Int(2, 65535, "Number of times the list will execute before "
+                  "stopping.")),
+    _Command('set_curr_step', "LIST:CURR {}, {}",
+             "Sets the current for a list step in units of A or mA.",
+             _Int(1, 80, "Step number in the active list."),
+             _Real('curr', _CURR_UNITS, "Current of the step.",
+                   suffix = 'A')),
+    _Command('get_curr_step', "LIST:CURR? {}",
+             "Returns the current level for a specific step.",
+             _Int(1, 80, "Step to be selected."), query = True),
+    _Command('set_list_mode', "LIST:MODE {}",
+             "Determines the response of the power supply to a trigger in "
+             "list mode.",
+             _Choice(['CONT', 'CONTINUED', 'STEP'],
+                     "Power supply response.")),
+    _Command('get_list_mode', "LIST:MODE?",
+             "Returns the response of the power supply to a trigger in list "
+             "mode.", query = True),
+    _Command('recall_list', "LIST:RCL {}",
+             "Recalls a previously saved list from the specified storage "
+             "location and\nmakes it the active list for editing or "
+             "execution.",
+             _Int(1, 8, "Specified storage location.")),
+    _Command('save_list', "LIST:SAV {}",
+             "Saves the active list file to a storage location in "
+             "nonvolatile\nmemory.",
+             _Int(1, 8, "Storage location.")),
+    _Command('set_steps', "LIST:STEP {}",
+             "Configures the number of steps in the active list. The number "
+             "of\nsteps must be configured before loading the voltage levels, "
+             "current\nlevels, and/or durations of the steps.",
+             _Int(2, 80, "Number of steps in the active list.",
+                  keywords = ('MIN', 'MAX'))),
+    _Command('set_volt_step', "LIST:VOLT {}, {}",
+             "Sets the voltage level of a specified step in a list in units "
+             "of V\nor mV.",
+             _Int(1, 80, "Step number in active list."),
+             _Real('volt', _VOLT_UNITS, "Voltage of the step.",
+                   suffix = 'V')),
+    _Command('set_step_duration', "LIST:WIDTH {}, {}",
+             "Sets the duration of a specified step in a list.",
+             _Int(1, 80, "Step in active list.", keywords = ('MIN', 'MAX')),
+             _Real((0, float('inf')), {'ms': 1, 's': 1000},
+                   "Duration of the step.", suffix = 'ms')),
+    
+    # Output
+    _Command('set_pon_state', "OUTP:PON {}",
+             "Configures the power supply to power up with its output turned "
+             "off,\nor to return the output to the state it was in when it "
+             "powered down.",
+             _Choice(['RST', 'RCL0'], "Configuration of the power supply.")),
+    _Command('get_pon_state', "OUTP:PON?",
+             "Returns power on state of the power supply.", query = True),
+    _Command('clear_trip', "OUTP:PROT:CLE",
+             "Clears a trip condition caused by over voltage (OV),\nover "
+             "temperature (OT), or remote inhibit (RI)."),
+    _Command('set_output_state', "OUTP {}",
+             "Turns the power supply output channel on or off.",
+             _Bool("Output channel status.")),
+    _Command('get_output_state', "OUTP?",
+             "Returns status of the power supply output.", query = True),
+    _Command('set_delay', "OUTP:TIM:DEL {}",
+             "Sets the time duration of the output timer.",
+             _Real((0.01, 60000), {'ms': 0.001, 's': 1}, "Time duration.",
+                   keywords = _LEVELS)),
+    _Command('get_delay', "OUTP:TIM:DEL?",
+             "Returns the time duration of the output timer.", query = True),
+    _Command('set_timer', "OUTP:TIM {}",
+             "Turns the output timer function on and off.",
+             _Bool("Status of output timer.")),
+    
+    # Voltage
+    _Command('set_volt', "VOLT {}",
+             "Sets the voltage value of the power supply.",
+             _Real('volt', _VOLT_UNITS, "Voltage value.", suffix = 'V',
+                   keywords = _LEVELS)),
+    _Command('get_voltage', "VOLT?",
+             "Returns the voltage setting of the power supply.",
+             query = True),
+    _Command('set_ovp', "VOLT:PROT {}",
+             "Sets the over voltage protection (OVP) threshold level.",
+             _Real('volt', _VOLT_UNITS, "Value of the OVP.", suffix = 'V',
+                   keywords = ('MIN', 'MAX'))),
+    _Command('get_ovp', "VOLT:PROT?", "Returns value of the OVP.",
+             query = True),
+    _Command('set_ovp_state', "VOLT:PROT:STAT {}",
+             "Activates or deactivates overvoltage protection.",
+             _Bool("State of the OVP.")),
+    _Command('get_ovp_state', "VOLT:PROT:STAT?",
+             "Returns the status of overvoltage protection.", query = True),
+    _Command('volt_range', "VOLT:RANG {}",
+             "Limits the maximum voltage that can be\nprogrammed on the power "
+             "supply. This command corresponds to\nthe front-panel Max "
+             "Voltage setting that can be found under the\nProtection "
+             "submenu. This function is different from OVP, since it\n"
+             "cannot turn the output off.",
+             _Real('volt', _VOLT_UNITS, "Value of max voltage.",
+                   suffix = 'V', keywords = _LEVELS)),
+    _Command('get_volt_range', "VOLT:RANG?",
+             "Returns the value of the voltage range.", query = True),
+    
+    # Status registers
+    _Command('get_ocr', "STAT:OPER:COND?",
+             "Returns the contents of the operation condition register "
+             "(OCR).", query = True),
+    _Command('set_oenr', "STAT:OPER:ENAB {}",
+             "Sets the contents of the operation enable register (OENR). The "
+             "OENR\nis an eight-bit mask register that determines which bits "
+             "in the\nOperation Event Register (OEVR) will affect the state "
+             "of the OPER bit\nin the Status Byte Register (SBR).",
+             _Int(0, 255, "Contents of OENR.")),
+    _Command('get_oenr', "STAT:OPER:ENAB?",
+             "Returns the contents of the operation enable register (OENR).",
+             query = True),
+    _Command('get_oevr', "STAT:OPER:EVEN?",
+             "Returns the contents of the operation event register (OEVR). "
+             "After\nexecuting this command the operation event register is "
+             "reset.", query = True),
+    _Command('get_qcr', "STAT:QUES:COND?",
+             "Returns the contents of the questionable condition register "
+             "(QCR).", query = True),
+    _Command('set_qenr', "STAT:QUES:ENAB {}",
+             "Sets the contents of the questionable enable register (QENR). "
+             "The QENR\nis an eight-bit mask register that determines which "
+             "bits in the\nQuestionable Event Register (QEVR) will affect the "
+             "state of the QUES\nbit in the Status Byte Register (SBR).",
+             _Int(0, 255, "The binary bits of the QENR are set according to "
+                  "this value.")),
+    _Command('get_qenr', "STAT:QUES:ENAB?",
+             "Returns the contents of the questionable enable register "
+             "(QENR).", query = True),
+    _Command('get_qevr', "STAT:QUES?",
+             "Returns the contents of the questionable event register (QEVR). "
+             "After\nexecuting this command, the questionable event register "
+             "is reset.", query = True),
+    _Command('set_ntr', "STAT:QUES:NTR {}",
+             "Sets the negative transition filter of the questionable event "
+             "register.\nThe filter contents cause the corresponding bit in "
+             "the questionable\nevent register to become 1 when the bit value "
+             "of the questionable\ncondition register transitions from 1 to "
+             "0.",
+             _Int(0, 255, "The binary bits of the questionable NTR register "
+                  "are set according\n    to this value.")),
+    _Command('get_ntr', "STAT:QUES:NTR?",
+             "Returns the value of the negative transition filter of the "
+             "questionable\nevent register.", query = True),
+    _Command('set_ptr', "STAT:QUES:PTR {}",
+             "Sets the positive transition filter of the questionable event "
+             "register.\nThe filter contents cause the corresponding bit in "
+             "the questionable\nevent register to become 1 when the bit value "
+             "of the questionable\ncondition register transitions from 0 to "
+             "1.",
+             _Int(0, 255, "The binary bits of the questionable PTR register "
+                  "are set according\n    to this value.")),
+    _Command('get_ptr', "STAT:QUES:PTR?",
+             "Returns the positive transition filter of the questionable "
+             "event\nregister.", query = True),
+    
+    # System
+    _Command('get_error', "SYST:ERR?",
+             "Queries the error code and error information of the power "
+             "supply and\nreturns both values.", query = True),
+    _Command('key', "SYST:KEY {}",
+             "This command can produce the same effect as pressing one of "
+             "the\nfront-panel buttons. The instrument must be in local mode "
+             "in order for\nthis command to simulate a front-panel button "
+             "press.",
+             _Int(1, 22, "Integer key code.", extra = (64,))),
+    _Command('syst_local', "SYST:LOC",
+             "Sets the power supply for control from the front panel."),
+    _Command('syst_pos', "SYST:POS {}",
+             "Determines how the power supply initializes when its power "
+             "switch is\nturned on. This command configures the instrument to "
+             "power up with\ndefault settings, or power up with the settings "
+             "that were in effect\nwhen the instrument was turned off.",
+             _Choice(['RST', 'RCL0'], "Initialization of the power "
+                     "setting.")),
+    _Command('get_syst_pos', "SYST:POS?",
+             "Returns the initialization setting of the power supply.",
+             query = True),
+    _Command('syst_remote', "SYST:REM",
+             "Sets the power supply to remote control mode."),
+    _Command('syst_lock', "SYST:RWL",
+             "If the power supply is in remote mode, this command locks out "
+             "the\nfront panel LOCAL button. This command has no effect if "
+             "the\ninstrument is in local mode."),
+    _Command('get_syst_version', "SYST:VER?",
+             "Returns SCPI version of the instrument.", query = True),
+    
+    # Trigger
+    _Command('force_trigger', "TRIG", "Forces an immediate trigger event."),
+    _Command('trigger_source', "TRIG:SOUR {}",
+             "Sets the source of trigger events.",
+             _Choice(['MAN', 'IMM', 'EXT', 'BUS'],
+                     "Source of trigger event.")),
+    _Command('get_trigger_source', "TRIG:SOUR?",
+             "Returns the source of the trigger event.", query = True),
+]
+
+_install_commands(KEI2220S, _COMMANDS)
 
-    def set_dfi_output(self, string):
-        """
-        Associates the DFI TTL output on the rear panel with a specified bit
-        in the status byte register (SBR). Once the bit is associated with
-        the DFI signal, the DFI signal will reflect the state of the
-        specified bit. The port needs to be in the DFI or RI mode before
-        using this command.  
 
+class Channel():
+    """
+    One output of a multi-output power supply, checked against the limits of
+    that output. Each operation selects the channel, acts on it and selects
+    channel 1 again in a single message, so that the commands of the
+    session keep acting on channel 1.
+    """
+    
+    def __init__(self, psu, number, max_volt, max_curr):
+        """
         Parameters
         ----------
-        string : str
-            State of the bit.
-        """
-        if str(string).upper() in ['OFF', 'QUES', 'OPER', 'ESB', 'RQS']:
-            self.inst.write(f"OUT:DFI:SOUR: {string}.upper")
-        else:
-            raise ValueError("ValueError. Please enter OFF, QUES, OPER, ESB, "
-                             "or RQS.")
+        psu : KEI2220S
+            Session of the power supply.
+        number : int
+            Channel number, starting at 1.
+        max_volt : float
+            Maximum voltage of the output in V.
+        max_curr : float
+            Maximum current of the output in A.
+        """
+        self.psu = psu
+        self.number = number
+        self.max_volt = max_volt
+        self.max_curr = max_curr
+        self._volt = _Real((0, max_volt), _VOLT_UNITS, "Voltage value.")
+        self._curr = _Real((0, max_curr), _CURR_UNITS, "Current value.")
         
-    def get_dfi_output(self):
-        """
-        Returns the DFI TTl output associated with a specific bit in the
-        status byte register (SBR).
-        """
-        dfi_output = str(self.inst.query("OUT:DFI:SOUR?"))
-        return(dfi_output)
+    def _message(self, command):
+        """Returns a command acting on the output as one message."""
+        return(f"INST:NSEL {self.number};:{command};:INST:NSEL 1")
+        
+    def encode_apply(self, volt, curr):
+        """Returns the APPL message setting voltage and current in V and A."""
+        return(f"APPL CH{self.number},"
+               f"{self._volt.convert(self.psu, volt, 'V')},"
+               f"{self._curr.convert(self.psu, curr, 'A')}")
     
-    def set_pon_state(self, string):
-        """
-        Configures the power supply to power up with its output turned off,
-        or to return the output to the state it was in when it powered down.
+    def apply(self, volt, curr):
+        """Sets the voltage in V and current in A of the output at once."""
+        self.psu.inst.write(_join([self.encode_apply(volt, curr),
+                                   "INST:NSEL 1"]))
+        
+    def set_volt(self, NRf, unit = 'V'):
+        """Sets the voltage of the output in units of V, mV or kV."""
+        self.psu.inst.write(self._message(
+            "VOLT " + self._volt.convert(self.psu, NRf, unit) + "V"))
+        
+    def set_curr(self, NRf, unit = 'A'):
+        """Sets the current of the output in units of A or mA."""
+        self.psu.inst.write(self._message(
+            "CURR " + self._curr.convert(self.psu, NRf, unit) + "A"))
+        
+    def set_output_state(self, boolean):
+        """Enables or disables the output."""
+        state = _OUTPUT_STATE.convert(self.psu, boolean)
+        self.psu.inst.write(self._message("OUTP:ENAB " + state))
+        
+    def get_last_volt(self):
+        """Returns the last measured voltage of the output."""
+        return(str(self.psu.inst.query(self._message("FETC:VOLT?"))))
+    
+    def get_last_curr(self):
+        """Returns the last measured current of the output."""
+        return(str(self.psu.inst.query(self._message("FETC:CURR?"))))
+
+
+_OUTPUT_STATE = _Bool("Output state.")
+
 
+class DigitalIO():
+    """
+    Rear-panel TTL port used for handshakes with external fixtures. The port
+    must be in DIGITAL mode, see set_dig_func. The last value written to the
+    port is remembered so that single pins can be changed without reading
+    the port first.
+    """
+    
+    def __init__(self, psu, width = 1):
+        """
         Parameters
         ----------
-        string : str
-            Configuration of the power supply.
-        """
-        if str(string).upper() in ['RST', 'RCL0']:
-            self.inst.write(f"OUTP:PON {string}.upper()")
-        else:
-            raise ValueError("Value Error. Please enter RST or RCL0.")
+        psu : KEI2220S
+            Session of the power supply.
+        width : int, optional
+            Number of pins of the port. The default is 1.
+        """
+        self.psu = psu
+        self.width = width
+        self.output = None
+        self._callbacks = []
+        self._events = None
+        self.errors = []
         
-    def get_pon_state(self):
-        """Returns power on state of the power supply."""
-        pon = str(self.inst.query("OUTP:PON?"))
-        return(pon)
+    def _check_pin(self, pin):
+        if int(pin) not in range(self.width):
+            raise ValueError("Value Error. Please enter a pin between 0 and "
+                             f"{self.width - 1}.")
+        return(int(pin))
     
-    def clear_trip(self):
+    def read(self):
+        """Returns the state of the port as an integer."""
+        return(int(float(self.psu.inst.query("DIG:DATA?"))))
+    
+    def read_with_sample(self):
         """
-        Clears a trip condition caused by over voltage (OV),
-        #over temperature(OT), or remote inhibit (RI).
+        Reads the port together with the last measured voltage and current
+        in one exchange.
+
+        Returns
+        -------
+        tuple
+            (timestamp in s, port state, voltage in V, current in A).
         """
-        self.inst.write("OUTP:PROT:CLE")
+        port, volt, curr = str(self.psu.inst.query(
+            "DIG:DATA?;:FETC:VOLT?;:FETC:CURR?")).split(';')
+        return(time.perf_counter(), int(float(port)), float(volt),
+               float(curr))
+    
+    def get_pin(self, pin):
+        """Returns the level of one pin, 0 or 1."""
+        return((self.read() >> self._check_pin(pin)) & 1)
+    
+    def write(self, value):
+        """Writes the whole port."""
+        if int(value) not in range(2 ** self.width):
+            raise ValueError("Value Error. Please enter an integer between 0 "
+                             f"and {2 ** self.width - 1}.")
+        self.psu.inst.write(f"DIG:DATA {int(value)}")
+        self.output = int(value)
         
-    def set_ri_pin(self, string):
+    def set_pin(self, pin, level):
         """
-        Sets the input mode of the RI (remote inhibit) input pin.
-
-        Parameters
-        ----------
-        string : str
-            Input mode.
+        Sets one pin of the port and leaves the others as last written. The
+        port is only read if nothing has been written to it in this session.
         """
-        if str(string).upper() in ['OFF', 'LATC', 'LATCHING', 'LIVE']:
-            self.inst.write(f"OUTP:RI:MODE {string}")
+        pin = self._check_pin(pin)
+        if self.output is None:
+            self.output = self.read()
+        if level:
+            self.write(self.output | (1 << pin))
         else:
-            raise ValueError("Value Error. Please enter OFF, LATC, LATCHING, "
-                             "or LIVE.")
-        
-    def get_ri_pin(self):
-        """Returns the input mode of the RI (remote inhibit) input pin."""
-        ri = str(self.inst.query("OUTP:RI:MODE?"))
-        return(ri)
-    
-    def set_output_state(self, boolean):
+            self.write(self.output & ~(1 << pin))
+            
+    def wait_for_pin(self, pin, level, timeout, max_interval = 0.05):
         """
-        The power supply output channel on or off.
+        Waits until a pin reaches a level. The port is polled back to back at
+        first, and the interval then doubles while nothing changes, up to
+        max_interval. A level is therefore seen at most max_interval after
+        it is set, while a long wait costs few exchanges.
 
         Parameters
         ----------
-        boolean : str, int
-            Output channel status.
-        """
-        if str(boolean).upper() in ['ON', 'OFF']:
-            self.inst.write(f"OUTP {boolean}.upper()")
-        if int(boolean) in range(2):
-            self.inst.write(f"OUTP {boolean}")
-        else:
-            raise ValueError("Value Error. Please enter ON, OFF, 0, or 1.")
+        pin : int
+            Pin to watch.
+        level : int
+            Level to wait for, 0 or 1.
+        timeout : float
+            Longest wait in seconds.
+        max_interval : float, optional
+            Longest time between two reads in seconds. The default is 0.05.
+
+        Returns
+        -------
+        float
+            Time waited in seconds.
+        """
+        pin = self._check_pin(pin)
+        level = 1 if level else 0
+        query = self.psu.inst.query
+        start = time.perf_counter()
+        deadline = start + timeout
+        interval = 0.0
+        while True:
+            if (int(float(query("DIG:DATA?"))) >> pin) & 1 == level:
+                return(time.perf_counter() - start)
+            now = time.perf_counter()
+            if now >= deadline:
+                raise TimeoutError(f"Timeout Error. Pin {pin} did not reach "
+                                   f"level {level} within {timeout} s.")
+            time.sleep(min(interval, deadline - now))
+            interval = min(max(2 * interval, 0.001), max_interval)
             
-    def get_output_state(self):
-        """Returns status of the power supply output."""
-        output = str(self.inst.query("OUTP?"))
-        return(output)
-    
-    def set_delay(self, NRf, unit = 'ms'):
+    def on_edge(self, pin, callback, edge = 'rising'):
         """
-        Sets the time duration of the output timer.
+        Registers a function called as callback(pin, level, timestamp) when
+        a pin changes. Events are only reported while start_events runs.
 
         Parameters
         ----------
-        NRf : float
-            Time duration.
-        unit : str, optional
-            Unit of time. The default is 'ms'.
-        """
-        if str(unit).lower() == 'ms' and float(NRf):
-            NRf = float(NRf) / 1000
-        if str(NRf).upper() in ['MIN', 'MAX', 'DEF']:
-            self.inst.write(f"OUTP:TIM:DEL {NRf}.upper()")
-        if 0.01 <= float(NRf) <= 60000:
-            self.inst.write(f"OUTP:TIM:DEL {NRf}")
-        else:
-            raise ValueError("Value Error. Please enter a value between 0.01s "
-                             "and 60,000s or MIN, MAX, or DEF.")
+        pin : int
+            Pin to watch.
+        callback : callable
+            Function to call.
+        edge : str, optional
+            'rising', 'falling' or 'both'. The default is 'rising'.
+        """
+        if edge not in ['rising', 'falling', 'both']:
+            raise ValueError("Value Error. Please enter rising, falling, or "
+                             "both.")
+        self._callbacks.append((self._check_pin(pin), callback, edge))
+        
+    def start_events(self, interval = 0.01):
+        """
+        Starts a thread that reads the port every interval seconds and calls
+        the registered edge callbacks. Failed reads are skipped, and an
+        exception raised by a callback is stored in errors as a (timestamp,
+        pin, exception) tuple, so neither stops the thread.
+        """
+        self.stop_events()
+        stopped = threading.Event()
+        thread = threading.Thread(target=self._poll_events,
+                                  args=(interval, stopped), daemon=True,
+                                  name='KEI2220S digital I/O')
+        self._events = (thread, stopped)
+        thread.start()
         
-    def get_delay(self):
-        """Returns the time duration of the output timer."""
-        delay = str(self.inst.query*"OUTP:TIM:DEL?")
-        return(delay)
+    def stop_events(self):
+        """Stops the edge event thread."""
+        if self._events is not None:
+            thread, stopped = self._events
+            stopped.set()
+            thread.join()
+            self._events = None
+            
+    def _poll_events(self, interval, stopped):
+        last = None
+        while True:
+            try:
+                port = self.read()
+            except (visa.VisaIOError, OSError, ValueError):
+                port = last
+            if last is not None:
+                changed = port ^ last
+                stamp = time.perf_counter()
+                for pin, callback, edge in self._callbacks:
+                    if not (changed >> pin) & 1:
+                        continue
+                    level = (port >> pin) & 1
+                    if (edge == 'both' or (edge == 'rising' and level) or
+                            (edge == 'falling' and not level)):
+                        try:
+                            callback(pin, level, stamp)
+                        except Exception as error:
+                            self.errors.append((stamp, pin, error))
+            last = port
+            if stopped.wait(interval):
+                break
+
+
+class PowerAccumulator():
+    """
+    Constant-memory accumulator of energy, charge, peak and RMS current and
+    time over a current threshold. Samples may arrive at irregular intervals;
+    the integrals use the trapezoidal rule over the time between consecutive
+    samples. No raw samples are kept.
+    """
     
-    def set_timer(self, boolean):
+    def __init__(self, curr_threshold = None):
         """
-        Turns the output timer function on and off.
-
         Parameters
         ----------
-        boolean : str, int
-            Status of output timer.
+        curr_threshold : float, optional
+            Current in A above which time is counted as over threshold. The
+            default is None, which disables the time over threshold.
         """
-        if str(boolean).upper() in ['ON', 'OFF']:
-            self.inst.write(f"OUTP:TIM {boolean}.upper()")
-        if int(boolean) in range(2):
-            self.inst.write(f"OUTP:TIM {boolean}")
-        else:
-            raise ValueError("Value Error. Please enter ON, OFF, 0, or 1.")
+        self.curr_threshold = curr_threshold
+        self.reset()
         
-    def set_volt(self, NRf, unit = 'V'):
+    def reset(self):
+        """Clears all accumulated values."""
+        self.samples = 0
+        self.first_time = None
+        self.last_time = None
+        self.duration = 0.0
+        self.energy = 0.0
+        self.charge = 0.0
+        self.curr_squared = 0.0
+        self.peak_curr = 0.0
+        self.time_over = 0.0
+        self._last = None
+        
+    def add(self, timestamp, volt, curr):
         """
-        Sets the voltage value of the power supply.
+        Adds one sample to the accumulator.
 
         Parameters
         ----------
-        NRf : str, float
-            Voltage value.
-        unit : str, optional
-            Unit of voltage. The default is 'V'.
-        """
-        if str(unit).upper() == 'MV' and float(NRf):
-            NRf = float(NRf) / 1000
-        if str(unit).upper() == 'KV' and float(NRf):
-            NRf = float(NRf) * 1000
-        
-        if str(NRf).upper() in ['MIN', 'MAX', 'DEF']:
-            self.inst.write(f"VOLT {NRf}.upper()")
-        if 0 <= float(NRf) <= 30:
-            self.inst.write(f"VOLT {NRf}")
+        timestamp : float
+            Time of the sample in seconds.
+        volt : float
+            Measured voltage in V.
+        curr : float
+            Measured current in A.
+        """
+        if self._last is not None:
+            last_time, last_volt, last_curr = self._last
+            dt = timestamp - last_time
+            if dt < 0:
+                raise ValueError("Value Error. Samples must be added in time "
+                                 "order.")
+            self.duration += dt
+            self.energy += 0.5 * (last_volt * last_curr + volt * curr) * dt
+            self.charge += 0.5 * (last_curr + curr) * dt
+            self.curr_squared += 0.5 * (last_curr ** 2 + curr ** 2) * dt
+            if self.curr_threshold is not None:
+                self.time_over += self._over(last_curr, curr, dt)
         else:
-            raise ValueError("Value Error. Please enter a value between 0 "
-                             "and 30, or MIN, MAX, or DEF.")
-            
-    def get_voltage(self):
-        """Returns the current of the power supply."""
-        volt = str(self.inst.query("VOLT?"))
-        return(volt)
+            self.first_time = timestamp
+        self.samples += 1
+        self.last_time = timestamp
+        self.peak_curr = max(self.peak_curr, abs(curr))
+        self._last = (timestamp, volt, curr)
+        
+    def _over(self, start, end, dt):
+        """
+        Returns the part of an interval during which the linearly
+        interpolated current is above the threshold.
+        """
+        threshold = self.curr_threshold
+        if start > threshold and end > threshold:
+            return(dt)
+        if start <= threshold and end <= threshold:
+            return(0.0)
+        fraction = (threshold - start) / (end - start)
+        if start > threshold:
+            return(dt * fraction)
+        return(dt * (1 - fraction))
+    
+    @property
+    def energy_wh(self):
+        """Returns the accumulated energy in Wh."""
+        return(self.energy / 3600)
+    
+    @property
+    def charge_ah(self):
+        """Returns the accumulated charge in Ah."""
+        return(self.charge / 3600)
+    
+    @property
+    def rms_curr(self):
+        """Returns the RMS current in A over the accumulated duration."""
+        if self.duration <= 0:
+            return(abs(self._last[2]) if self._last else 0.0)
+        return((self.curr_squared / self.duration) ** 0.5)
+    
+    def snapshot(self):
+        """Returns the accumulated values as a dictionary."""
+        return({'samples': self.samples,
+                'first_time': self.first_time,
+                'last_time': self.last_time,
+                'duration_s': self.duration,
+                'energy_wh': self.energy_wh,
+                'charge_ah': self.charge_ah,
+                'peak_curr_a': self.peak_curr,
+                'rms_curr_a': self.rms_curr,
+                'time_over_s': self.time_over})
     
-    def set_ovp(self, NRf, unit = 'V'):
+    def merge(self, other):
         """
-        Sets the over voltage protection (OVP) threshold level.
+        Returns a new accumulator combining this one with another, for
+        example from another supply or another time window. The intervals
+        between the two are not integrated.
 
         Parameters
         ----------
-        NRf : str, float
-            Value of the OVP.
-        unit : str, optional
-            Unit of voltage. The default is 'V'.
-        """
-        if str(unit).upper() == 'MV' and float(NRf):
-            NRf = NRf / 1000
-        if str(NRf).upper() in ['MIN', 'MAX']:
-            self.inst.write(f"VOLT:PROT {NRf}")
-        if 0 <= float(NRf) <= 30:
-            self.inst.write(f"VOLT:PROT {NRf}V")
-        else:
-            raise ValueError("Value Error. Please enter a value between 0 and"
-                             " 30 or MIN or MAX.")
-    def get_ovp(self):
-        """Returns value of the OVP."""
-        ovp = str(self.inst.query("VOLT:PROT?"))
-        return(ovp)
+        other : PowerAccumulator
+            Accumulator to merge with.
+        """
+        if self.curr_threshold != other.curr_threshold:
+            raise ValueError("Value Error. Accumulators must use the same "
+                             "current threshold.")
+        merged = PowerAccumulator(self.curr_threshold)
+        merged.samples = self.samples + other.samples
+        times = [t for t in (self.first_time, other.first_time)
+                 if t is not None]
+        merged.first_time = min(times) if times else None
+        times = [t for t in (self.last_time, other.last_time)
+                 if t is not None]
+        merged.last_time = max(times) if times else None
+        for name in ['duration', 'energy', 'charge', 'curr_squared',
+                     'time_over']:
+            setattr(merged, name, getattr(self, name) + getattr(other, name))
+        merged.peak_curr = max(self.peak_curr, other.peak_curr)
+        lasts = [last for last in (self._last, other._last) if last]
+        merged._last = max(lasts) if lasts else None
+        return(merged)
+
+
+
+class RecordingTransport():
+    """
+    Wraps a VISA resource and records every write and query, with its reply
+    and timing, to a log file. Each line of the log is a JSON list of
+    [start time, duration, kind, command, reply] where the start time is
+    relative to the start of the recording and kind is 'W' or 'Q'. A write
+    or query that raises is recorded with kind 'E' and a reply of [failed
+    kind, exception type, exception text, VISA error code or None]. Every
+    line is flushed as it is written, so a crashed session still leaves a
+    usable recording.
+    """
     
-    def set_ovp_state(self, boolean):
+    def __init__(self, inst, path):
         """
-        Activates, deactivates, or checks the status of overvoltage protection.
-
         Parameters
         ----------
-        boolean : str
-            State of the OVP.
-        """
-        if str(boolean).upper() in ['ON', 'OFF']:
-            self.inst.write(f"VOLT:PROT:STAT {boolean}.upper()")
-        if int(boolean) in range(2):
-            self.inst.write(f"VOLT:PROT:STAT {boolean}")
-        else:
-            raise ValueError("Value Error. Please enter 1, 0, ON, or OFF.")
+        inst : object
+            The VISA resource to wrap.
+        path : str
+            Path of the log file. An existing file is overwritten.
+        """
+        self.inst = inst
+        self.log = open(path, 'w')
+        self._start = time.perf_counter()
         
-    def get_ovp_state(self):
-        """Returns the status of overvoltage protection."""
-        ovp_state = str(self.inst.query("VOLT:PROT:STAT?"))
-        return(ovp_state)
+    def __getattr__(self, name):
+        return(getattr(self.inst, name))
     
-    def volt_range(self, NRf, unit = 'V'):
-        """
-        Limits the maximum voltage that can be
-        programmed on the power supply. This command corresponds to
-        the front-panel Max Voltage setting that can be found under the
-        Protection submenu. This function is different from OVP, since it
-        cannot turn the output off.
+    def _record(self, start, kind, command, reply):
+        self.log.write(json.dumps([round(start - self._start, 6),
+                                   round(time.perf_counter() - start, 6),
+                                   kind, command, reply],
+                                  separators=(',', ':')) + '\n')
+        self.log.flush()
+        
+    def _record_error(self, start, kind, command, error):
+        self._record(start, 'E', command,
+                     [kind, type(error).__name__, str(error),
+                      getattr(error, 'error_code', None)])
+        
+    def write(self, command):
+        """Writes a command to the instrument and records it."""
+        start = time.perf_counter()
+        try:
+            count = self.inst.write(command)
+        except Exception as error:
+            self._record_error(start, 'W', command, error)
+            raise
+        self._record(start, 'W', command, None)
+        return(count)
+    
+    def query(self, command):
+        """Queries the instrument and records the command and reply."""
+        start = time.perf_counter()
+        try:
+            reply = self.inst.query(command)
+        except Exception as error:
+            self._record_error(start, 'Q', command, error)
+            raise
+        self._record(start, 'Q', command, reply)
+        return(reply)
+    
+    def close(self):
+        """Closes the log file and the wrapped resource."""
+        self.log.close()
+        self.inst.close()
+
 
+class ReplayTransport():
+    """
+    Serves the replies of a log written by RecordingTransport. The commands
+    sent by the driver are checked against the recording, so any change in
+    the traffic the driver produces is reported. A recorded failure is
+    raised again, as a VisaIOError with the recorded code, as the built-in
+    exception of the same name, or else as a RuntimeError.
+    """
+    
+    def __init__(self, path, realtime = False):
+        """
         Parameters
         ----------
-        NRf : str, float
-            Value of max voltage.
-        unit : str, optional
-            Unit of voltage. The default is 'V'.
-        """
-        if str(unit).upper() == 'MV' and float(NRf):
-            NRf = float(NRf) / 1000
-        if str(unit).upper() == 'KV' and float(NRf):
-            NRf = float(NRf) * 1000
-        if str(NRf).upper() in ['MIN', 'MAX', 'DEF']:
-            self.inst.write(f"VOLT:RANG {NRf}.upper()")
-        if 0 <= float(NRf) <= 30:
-            self.inst.write(f"VOLT:RANG {NRf}V")
-        else:
-            raise ValueError("Value Error. Please enter a voltage between 0 "
-                             "and 30, or MIN, MAX, or DEF.")
+        path : str
+            Path of the log file.
+        realtime : bool, optional
+            If True, replies are served at the recorded speed, otherwise as
+            fast as possible. The default is False.
+        """
+        with open(path) as log:
+            self.records = [json.loads(line) for line in log if line.strip()]
+        self.realtime = realtime
+        self.position = 0
+        self._start = time.perf_counter()
         
-    def get_volt_range(self):
-        """Returns the value of the voltage range."""
-        volt_range = str(self.inst.query("VOLT:RANG?"))
-        return(volt_range)
+    def _next(self, kind, command):
+        if self.position >= len(self.records):
+            raise RuntimeError("Replay Error. The recording has no more "
+                               f"traffic for {kind} {command!r}.")
+        start, duration, rec_kind, rec_command, reply = \
+            self.records[self.position]
+        failed = rec_kind == 'E'
+        if failed:
+            rec_kind = reply[0]
+        if (rec_kind, rec_command) != (kind, command):
+            raise RuntimeError(f"Replay Error. Expected {rec_kind} "
+                               f"{rec_command!r} at record {self.position}, "
+                               f"got {kind} {command!r}.")
+        self.position += 1
+        if self.realtime:
+            delay = start + duration - (time.perf_counter() - self._start)
+            if delay > 0:
+                time.sleep(delay)
+        if failed:
+            raise self._error(*reply[1:])
+        return(reply)
     
-    def set_sre(self, NR1):
-        """
-        Sets the bits in the service request enable register (SRER).
+    @staticmethod
+    def _error(name, text, code):
+        """Returns the exception recorded by RecordingTransport."""
+        if name == 'VisaIOError' and code is not None:
+            return(visa.VisaIOError(code))
+        error = getattr(builtins, name, None)
+        if isinstance(error, type) and issubclass(error, Exception):
+            return(error(text))
+        return(RuntimeError(f"Replay Error. {name}: {text}"))
+    
+    def write(self, command):
+        """Checks a command against the recording."""
+        self._next('W', command)
+        return(len(command))
+    
+    def query(self, command):
+        """Returns the recorded reply to a query."""
+        return(self._next('Q', command))
+    
+    def rewind(self):
+        """Restarts the replay from the first record."""
+        self.position = 0
+        self._start = time.perf_counter()
+        
+    def close(self):
+        """Closes the replay."""
+        pass
 
+
+class Capture():
+    """
+    Acquired samples stored in contiguous typed columns: timestamp, volt,
+    curr and power as 64-bit floats, and status as 32-bit unsigned integers
+    holding the questionable condition register. The columns can be
+    exported to NumPy, pandas and Arrow without copying. With a spill path,
+    full chunks are moved to a file so captures larger than memory can be
+    exported chunk by chunk.
+    """
+    
+    columns = ('timestamp', 'volt', 'curr', 'power', 'status')
+    typecodes = ('d', 'd', 'd', 'd', 'I')
+    
+    def __init__(self, chunk_rows = 65536, spill_path = None):
+        """
         Parameters
         ----------
-        NR1 : int
-            Bit of the SRER.
+        chunk_rows : int, optional
+            Number of rows per chunk. The default is 65536.
+        spill_path : str, optional
+            File to which full chunks are written. The default is None, which
+            keeps every row in memory.
+        """
+        self.chunk_rows = chunk_rows
+        self.spill_path = spill_path
+        self.spilled_chunks = 0
+        self._new_chunk()
+        if spill_path is not None:
+            open(spill_path, 'wb').close()
+        
+    def _new_chunk(self):
+        self._data = [array.array(code) for code in self.typecodes]
+        (self._timestamp, self._volt, self._curr, self._power,
+         self._status) = self._data
+        
+    def __len__(self):
+        return(self.spilled_chunks * self.chunk_rows + len(self._timestamp))
+    
+    def append(self, timestamp, volt, curr, power, status = 0):
+        """Appends one sample to the capture."""
+        self._timestamp.append(timestamp)
+        self._volt.append(volt)
+        self._curr.append(curr)
+        self._power.append(power)
+        self._status.append(status)
+        if (self.spill_path is not None and
+                len(self._timestamp) >= self.chunk_rows):
+            self._spill()
+            
+    def _spill(self):
+        """Writes the rows in memory to the spill file as one chunk."""
+        with open(self.spill_path, 'ab') as spill:
+            for column in self._data:
+                column.tofile(spill)
+        self.spilled_chunks += 1
+        self._new_chunk()
+        
+    def _dtypes(self):
+        import numpy
+        return([numpy.dtype(code) for code in self.typecodes])
+    
+    def to_numpy(self):
         """
-        if int(NR1) in range(256):
-            self.inst.write(f"*SRE {NR1}")
-        else:
-            raise ValueError("Value Error. Please enter an integer between 0 "
-                             "and 255.")
-    def get_sre(self):
-        """Returns the bits of the service request enable register (SRER)."""
-        sre = str(self.inst.query("*SRE?"))
-        return(sre)
+        Returns the columns as a dictionary of NumPy arrays sharing the
+        memory of the capture. The arrays must be released before more
+        samples are appended.
+        """
+        if self.spilled_chunks:
+            raise ValueError("Value Error. The capture has been spilled to "
+                             "disk, please use iter_chunks.")
+        return(self._numpy_chunk(self._data))
     
-    def get_ocr(self):
-        """Returns the contents of the operation condition register (OCR)."""
-        ocr = str(self.inst.query("STAT:OPER:COND?"))
-        return(ocr)
+    def _numpy_chunk(self, data):
+        import numpy
+        return({name: numpy.frombuffer(column, dtype)
+                for name, column, dtype in zip(self.columns, data,
+                                               self._dtypes())})
+        
+    def to_structured(self):
+        """
+        Returns the capture as a NumPy structured array. A structured array
+        interleaves the fields of each row, so unlike the other exports this
+        one copies the columns.
+        """
+        import numpy
+        columns = self.to_numpy()
+        records = numpy.empty(len(self), dtype=list(zip(self.columns,
+                                                        self._dtypes())))
+        for name in self.columns:
+            records[name] = columns[name]
+        return(records)
     
-    def set_oenr(self, NR1):
+    def to_pandas(self):
         """
-        Sets  the contents of the operation enable register (OENR). The OENR
-        is an eight-bit mask register that determines which bits in the
-        Operation Event Register (OEVR) will affect the state of the OPER bit
-        in the Status Byte Register (SBR).
-
-        Parameters
-        ----------
-        NR1 : int
-            Contents of OENR.
+        Returns the capture as a pandas DataFrame built on the NumPy columns
+        without copying them.
         """
-        if int(NR1) in range(256):
-            self.inst.write(f"STAT:OPER:ENAB {NR1}")
-        else:
-            raise ValueError("Value Error. Please enter an integer between 0 "
-                             "and 256.")
-    def get_oenr(self):
-        """Returns the contents of the operation enable register (OENR)."""
-        oenr = str(self.inst.query("STAT:OPER:ENAB?"))
-        return(oenr)
+        import pandas
+        return(pandas.DataFrame(self.to_numpy(), copy=False))
     
-    def get_oevr(self):
+    def to_arrow(self):
         """
-        Returns the contents of the operation event register (OEVR). After
-        executing this command the operation event register is reset.
+        Returns the capture as an Arrow record batch whose arrays wrap the
+        buffers of the capture.
         """
-        oevr = str(self.inst.query("STAT:OPER:EVEN?"))
-        return(oevr)
+        if self.spilled_chunks:
+            raise ValueError("Value Error. The capture has been spilled to "
+                             "disk, please use iter_chunks.")
+        return(self._arrow_chunk(len(self._timestamp), self._data))
     
-    def get_qcr(self):
-        """Returns the contents of the questionable condition register (QCR)"""
-        qcr = str(self.inst.query("STAT:QUEST:COND?"))
-        return(qcr)
+    def _arrow_chunk(self, rows, data):
+        import pyarrow
+        types = {'d': pyarrow.float64(), 'I': pyarrow.uint32()}
+        arrays = [pyarrow.Array.from_buffers(types[code], rows,
+                                             [None, pyarrow.py_buffer(column)])
+                  for code, column in zip(self.typecodes, data)]
+        return(pyarrow.RecordBatch.from_arrays(arrays, list(self.columns)))
     
-    def set_qenr(self, NR1):
+    def iter_chunks(self, kind = 'numpy'):
         """
-        Sets the contents of the questionable enable register (QENR). The QENR
-        is an eight-bit mask register that determines which bits in the
-        Questionable Event Register( QEVR) will affect the state of the QUES
-        bit in the Status Byte Register (SBR).
+        Yields the capture one chunk at a time. Spilled chunks are memory
+        mapped from the spill file, so only the chunk in use is paged in.
 
         Parameters
         ----------
-        NR1 : int
-            A decimal integer ranging from 0 through 255. The binary bits 
-            of the QENR are set according to this value.
-        """
-        if int(NR1) in range(256):
-            self.inst.write(f"STAT:QUEST:ENAB {NR1}")
-        else:
-            raise ValueError("Value Error. Please enter an integer between 0 "
-                             "and 255")
-    def get_qenr(self):
-        """Returns the contents of the questionable enable register (QENR)."""
-        qenr = str(self.inst.query("STAT:QUEST:ENAB?"))
-        return(qenr)
+        kind : str, optional
+            'numpy' for dictionaries of NumPy arrays, 'pandas' for
+            DataFrames or 'arrow' for record batches. The default is
+            'numpy'.
+        """
+        if kind not in ['numpy', 'pandas', 'arrow']:
+            raise ValueError("Value Error. Please enter numpy, pandas, or "
+                             "arrow.")
+        chunks = [(len(self._timestamp), self._data)]
+        if self.spilled_chunks:
+            chunks = self._mapped_chunks() + chunks
+        for rows, data in chunks:
+            if kind == 'arrow':
+                yield self._arrow_chunk(rows, data)
+            elif kind == 'pandas':
+                import pandas
+                yield pandas.DataFrame(self._numpy_chunk(data), copy=False)
+            else:
+                yield self._numpy_chunk(data)
+    
+    def _mapped_chunks(self):
+        """
+        Returns the spilled chunks as pairs of row count and list of memory
+        mapped columns.
+        """
+        import numpy
+        mapped = numpy.memmap(self.spill_path, dtype='u1', mode='r')
+        chunks = []
+        offset = 0
+        for _ in range(self.spilled_chunks):
+            data = []
+            for dtype in self._dtypes():
+                size = dtype.itemsize * self.chunk_rows
+                data.append(mapped[offset:offset + size])
+                offset += size
+            chunks.append((self.chunk_rows, data))
+        return(chunks)
     
-    def get_qevr(self):
+    def close(self):
+        """Removes the spill file."""
+        if self.spill_path is not None and os.path.exists(self.spill_path):
+            os.remove(self.spill_path)
+            self.spilled_chunks = 0
+
+
+class StepResponse():
+    """
+    Step response of the output computed from a capture taken after an
+    action. Times are in seconds from the action; the midpoint of each
+    exchange is used as the time of its sample.
+    """
+    
+    def __init__(self, capture, start, initial, quantity = 'volt',
+                 band = 0.02):
         """
-        Returns the contents of the questionable event register (QEVR). After
-        executing this command, the quest event register is reset.
+        Parameters
+        ----------
+        capture : Capture
+            Samples taken after the action.
+        start : float
+            Time of the action in seconds.
+        initial : float
+            Value of the quantity before the action.
+        quantity : str, optional
+            Analysed quantity, 'volt' or 'curr'. The default is 'volt'.
+        band : float, optional
+            Settling band as a fraction of the step size. The default is
+            0.02.
+        """
+        self.capture = capture
+        self.quantity = quantity
+        self.band = band
+        self.initial = initial
+        self.times = [stamp - start for stamp in capture._timestamp]
+        self.values = list(getattr(capture, '_' + quantity))
+        if not self.values:
+            raise ValueError("Value Error. The capture holds no samples.")
+        tail = self.values[-max(1, len(self.values) // 10):]
+        self.final = sum(tail) / len(tail)
+        self.sample_rate = ((len(self.times) - 1) /
+                            (self.times[-1] - self.times[0])
+                            if len(self.times) > 1 and
+                            self.times[-1] > self.times[0] else None)
+        self.rise_time = None
+        self.overshoot = 0.0
+        self.settling_time = None
+        step = self.final - initial
+        if abs(step) > 1e-9:
+            self._analyse([(value - initial) / step
+                           for value in self.values])
+            
+    def _analyse(self, normalized):
+        """Computes the metrics from the values normalized to the step."""
+        rise_start = rise_end = None
+        for stamp, value in zip(self.times, normalized):
+            if rise_start is None and value >= 0.1:
+                rise_start = stamp
+            if value >= 0.9:
+                rise_end = stamp
+                break
+        if rise_start is not None and rise_end is not None:
+            self.rise_time = rise_end - rise_start
+        self.overshoot = max(0.0, max(normalized) - 1) * 100
+        self.settling_time = self.times[0]
+        for index in range(len(normalized) - 1, -1, -1):
+            if abs(normalized[index] - 1) > self.band:
+                if index + 1 < len(normalized):
+                    self.settling_time = self.times[index + 1]
+                else:
+                    self.settling_time = None
+                break
+            
+    def summary(self):
+        """Returns the step response metrics as a dictionary."""
+        return({'quantity': self.quantity,
+                'initial': self.initial,
+                'final': self.final,
+                'rise_time_s': self.rise_time,
+                'overshoot_pct': self.overshoot,
+                'settling_time_s': self.settling_time,
+                'samples': len(self.values),
+                'sample_rate_hz': self.sample_rate})
+
+
+# Commands whose repeats all take effect, so they are never merged away.
+_REPEATABLE = ('*', 'LIST:', 'SYST:KEY', 'TRIG')
+
+
+def _setting(message):
+    """
+    Returns the header of a write that only changes one setting, or None for
+    writes that must always be sent: compound messages and commands whose
+    repeats all take effect.
+    """
+    if ';' in message or message.upper().startswith(_REPEATABLE):
+        return(None)
+    return(message.split(' ', 1)[0].upper())
+
+
+def _merge_writes(messages):
+    """
+    Returns a run of write messages without those overridden by the write
+    right after them. A write is only dropped when the next write sets the
+    same setting, so every other write still sees the state it was queued
+    after.
+    """
+    merged = []
+    for index, message in enumerate(messages):
+        header = _setting(message)
+        if (header is not None and index + 1 < len(messages) and
+                _setting(messages[index + 1]) == header):
+            continue
+        merged.append(message)
+    return(merged)
+
+
+def _join(messages):
+    """Joins SCPI messages into one compound message."""
+    return(';'.join(message if index == 0 or message.startswith('*')
+                    else ':' + message
+                    for index, message in enumerate(messages)))
+
+
+class SessionWorker():
+    """
+    Thread that owns a transport and processes a priority queue of writes
+    and queries, returning futures. Safety commands such as turning the
+    output off go ahead of control commands, which go ahead of bulk
+    measurement reads. So that an output off is never overtaken by a write
+    queued before it, queuing a safety write fails every write still
+    waiting in the queue. Writes of the same priority that are next to each
+    other in the queue are sent as one message, and a control write is
+    dropped when the write right after it sets the same parameter. Safety
+    writes are never dropped.
+    """
+    
+    SAFETY = 0
+    CONTROL = 1
+    BULK = 2
+    
+    def __init__(self, transport, max_merge = 16):
         """
-        qevr = str(self.inst.query("STAT:QUES?"))
-        return(qevr)
+        Parameters
+        ----------
+        transport : object
+            Transport with write and query methods, like a VISA resource.
+        max_merge : int, optional
+            Maximum number of writes sent as one message. The default is 16.
+        """
+        self.transport = transport
+        self.max_merge = max_merge
+        self.queue = queue.PriorityQueue()
+        self._order = itertools.count()
+        self._lock = threading.Lock()
+        self.thread = threading.Thread(target=self._run, daemon=True,
+                                       name='KEI2220S worker')
+        self.thread.start()
+        
+    def priority(self, message, query):
+        """Returns the default priority of a message."""
+        header = message.upper()
+        if not query and header.startswith('OUTP ') and \
+                header[5:].strip() in ['0', 'OFF']:
+            return(self.SAFETY)
+        if query and header.startswith(('FETC', 'MEAS')):
+            return(self.BULK)
+        return(self.CONTROL)
     
-    def set_ntr(self, NR1):
+    def submit(self, message, query = False, priority = None,
+               parser = None):
         """
-        Sets the negative transition filter of the questionable event register.
-        The filter contents cause the corresponding bit in the questionable
-        event register to become 1 when the bit value of the questionable
-        condition register transitions from 1 to 0.
+        Queues a message.
 
         Parameters
         ----------
-        NR1 : int
-             A number ranging from 0 through 255. The binary bits of the
-             Questionable NTR register are set according to this value.
-        """
-        if int(NR1) in range(256):
-            self.inst.write(f"STAT:QUES:NTR {NR1}")
+        message : str
+            SCPI message.
+        query : bool, optional
+            True if the message is a query. The default is False.
+        priority : int, optional
+            SAFETY, CONTROL or BULK. The default is None, which picks the
+            priority from the message.
+        parser : callable, optional
+            Applied to the reply of a query. The default is None.
+
+        Returns
+        -------
+        Future
+            Resolves to the reply of a query, or to None for a write. A
+            write still queued when a safety write is queued fails with a
+            RuntimeError instead of being sent.
+        """
+        if priority is None:
+            priority = self.priority(message, query)
+        future = Future()
+        with self._lock:
+            if priority == self.SAFETY and not query:
+                self._cancel_writes()
+            self.queue.put((priority, next(self._order),
+                            (message, query, parser, future)))
+        return(future)
+    
+    def _cancel_writes(self):
+        """Removes the queued writes and fails their futures."""
+        with self.queue.mutex:
+            kept, cancelled = [], []
+            for item in self.queue.queue:
+                if item[2] is None or item[2][1] or item[0] == self.SAFETY:
+                    kept.append(item)
+                else:
+                    cancelled.append(item[2])
+            self.queue.queue[:] = kept
+            heapq.heapify(self.queue.queue)
+        for message, query, parser, future in cancelled:
+            if future.set_running_or_notify_cancel():
+                future.set_exception(RuntimeError(
+                    f"Worker Error. {message} was cancelled by an output "
+                    "off queued after it."))
+    
+    def write(self, message, priority = None):
+        """Queues a write and returns its future."""
+        return(self.submit(message, False, priority))
+    
+    def query(self, message, priority = None):
+        """Queues a query and returns its future."""
+        return(self.submit(message, True, priority))
+    
+    def stop(self):
+        """Processes the queued commands and stops the thread."""
+        self.queue.put((float('inf'), next(self._order), None))
+        self.thread.join()
+        
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item[2] is None:
+                break
+            message, query, parser, future = item[2]
+            if query:
+                self._query(message, parser, future)
+            else:
+                self._write(self._gather(item), item[0])
+                
+    def _gather(self, first):
+        """Takes the writes of the same priority that follow a write."""
+        batch = [first[2]]
+        while len(batch) < self.max_merge:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item[2] is None or item[2][1] or item[0] != first[0]:
+                self.queue.put(item)
+                break
+            batch.append(item[2])
+        return(batch)
+    
+    def _write(self, batch, priority):
+        batch = [entry for entry in batch
+                 if entry[3].set_running_or_notify_cancel()]
+        messages = [entry[0] for entry in batch]
+        if priority != self.SAFETY:
+            messages = _merge_writes(messages)
+        message = _join(messages)
+        try:
+            if message:
+                self.transport.write(message)
+        except Exception as error:
+            for entry in batch:
+                entry[3].set_exception(error)
         else:
-            raise ValueError("ValueError. Please enter an integer between 0 "
-                             "and 255.")
+            for entry in batch:
+                entry[3].set_result(None)
+                    
+    def _query(self, message, parser, future):
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            reply = self.transport.query(message)
+            future.set_result(parser(reply) if parser else reply)
+        except Exception as error:
+            future.set_exception(error)
+
+
+class _QueuedTransport():
+    """
+    Transport handed to the driver while a SessionWorker owns the session.
+    Each write and query is queued on the worker and waited for.
+    """
+    
+    def __init__(self, worker):
+        self.worker = worker
+        
+    def write(self, message):
+        self.worker.write(message).result()
+        return(len(message))
+    
+    def query(self, message):
+        return(self.worker.query(message).result())
+    
+    def close(self):
+        self.worker.stop()
+        self.worker.transport.close()
+
+
+class _Link():
+    """
+    Transport of a session opened from an address. Access to the resource
+    is serialized with a lock. When an error shows that the connection was
+    lost, the resource is reopened at the same address and the error is
+    raised; the message is not sent again, since the caller knows whether
+    it is safe to repeat. Other errors, such as timeouts, are raised
+    without a reopen. The link also remembers the remote or lock state so
+    that a reopen can restore it.
+    """
+    
+    _REMOTE_STATES = ('SYST:REM', 'SYST:RWL', 'SYST:LOC')
+    
+    # VISA status codes of a lost connection: VI_ERROR_CONN_LOST,
+    # VI_ERROR_INV_OBJECT, VI_ERROR_RSRC_NFOUND and VI_ERROR_IO.
+    _LOST_CODES = (-1073807194, -1073807346, -1073807343, -1073807298)
+    
+    def __init__(self, psu, resource):
+        self.psu = psu
+        self.resource = resource
+        self.lock = threading.RLock()
+        self.remote_state = None
+        self.last_io = time.monotonic()
+        
+    def __getattr__(self, name):
+        return(getattr(self.resource, name))
+    
+    def _call(self, method, message):
+        with self.lock:
+            try:
+                result = getattr(self.resource, method)(message)
+            except (visa.VisaIOError, OSError) as error:
+                if (not isinstance(error, visa.VisaIOError) or
+                        getattr(error, 'error_code', None) in
+                        self._LOST_CODES):
+                    try:
+                        self.reopen()
+                    except (visa.VisaIOError, OSError):
+                        pass
+                raise
+            self.last_io = time.monotonic()
+            return(result)
+        
+    def write(self, message):
+        for part in message.upper().split(';'):
+            if part.lstrip(':') in self._REMOTE_STATES:
+                self.remote_state = part.lstrip(':')
+        return(self._call('write', message))
+    
+    def query(self, message):
+        return(self._call('query', message))
+    
+    def reopen(self):
+        """Reopens the resource and restores the remote or lock state."""
+        with self.lock:
+            try:
+                self.resource.close()
+            except Exception:
+                pass
+            self.resource = self.psu._open_resource()
+            if self.remote_state == 'SYST:RWL':
+                self.resource.write('SYST:REM;:SYST:RWL')
+            elif self.remote_state is not None:
+                self.resource.write(self.remote_state)
+            self.last_io = time.monotonic()
             
-    def get_ntr(self):
-        """
-        Returns the value of the negative transition filter of the questionable
-        event register.
+    def close(self):
+        self.resource.close()
+
+
+class _KeepAlive():
+    """Thread sending *OPC? when a link has been idle for an interval."""
+    
+    def __init__(self, link, interval):
+        self.link = link
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True,
+                                       name='KEI2220S keep-alive')
+        self.thread.start()
+        
+    def _run(self):
+        while not self.stopped.wait(self.interval / 2):
+            if time.monotonic() - self.link.last_io >= self.interval:
+                try:
+                    self.link.query("*OPC?")
+                except Exception:
+                    pass
+                
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+
+class ResourceDiscovery():
+    """
+    Maps the serial numbers of the connected power supplies to their address,
+    baud rate and model. Resources are probed in parallel with *IDN?, and the
+    map is kept in a JSON cache file so that later sessions can be opened
+    without a scan.
+    """
+    
+    default_cache_path = os.path.join(os.path.expanduser('~'),
+                                      '.kei2220s_resources.json')
+    
+    def __init__(self, cache_path = None,
+                 baud_rates = (9600, 115200, 57600, 38400, 19200, 4800),
+                 timeout = 500, workers = 16):
         """
-        ntr = str(self.inst.query("STAT:QUES:NTR?"))
-        return(ntr)
+        Parameters
+        ----------
+        cache_path : str, optional
+            Path of the cache file. The default is None, which uses
+            default_cache_path.
+        baud_rates : tuple, optional
+            Baud rates tried on serial resources, in order.
+        timeout : int, optional
+            Timeout of each probe in milliseconds. The default is 500.
+        workers : int, optional
+            Number of resources probed at the same time. The default is 16.
+        """
+        self.cache_path = cache_path or self.default_cache_path
+        self.baud_rates = baud_rates
+        self.timeout = timeout
+        self.workers = workers
+        self.entries = self.load()
+        
+    def load(self):
+        """Returns the entries of the cache file, or none if it is missing."""
+        try:
+            with open(self.cache_path) as cache:
+                return(json.load(cache))
+        except (OSError, ValueError):
+            return({})
+        
+    def save(self):
+        """Writes the entries to the cache file."""
+        with open(self.cache_path, 'w') as cache:
+            json.dump(self.entries, cache, indent=1, sort_keys=True)
+            
+    def probe(self, address):
+        """
+        Returns the cache entry of the power supply at an address, or None if
+        no supported power supply answers there.
+        """
+        rm = KEI2220S.resource_manager()
+        serial = address.upper().startswith('ASRL')
+        for baud_rate in (self.baud_rates if serial else (None,)):
+            options = {'timeout': self.timeout,
+                       'read_termination': '\n',
+                       'write_termination': '\n'}
+            if baud_rate is not None:
+                options['baud_rate'] = baud_rate
+            try:
+                resource = rm.open_resource(address, **options)
+            except (visa.VisaIOError, OSError):
+                return(None)
+            try:
+                idn = [field.strip() for field in
+                       str(resource.query("*IDN?")).split(',')]
+            except (visa.VisaIOError, OSError):
+                continue
+            finally:
+                resource.close()
+            if len(idn) >= 4 and idn[1].replace(' ', '') in _MODELS:
+                return({'address': address, 'baud_rate': baud_rate,
+                        'model': idn[1].replace(' ', ''), 'idn': idn})
+        return(None)
     
-    def set_ptr(self, NR1):
+    def scan(self, addresses = None):
         """
-        Sets the positive transition filter of the questionable event register.
-        The filter contents cause the corresponding bit in the questionable
-        event register to become 1 when the bit value of the questionable
-        condition register transitions from 0 to 1.
+        Probes resources in parallel, updates the entries with the power
+        supplies found and saves the cache. Cached entries at a probed
+        address that now holds another power supply, or none, are removed.
 
         Parameters
         ----------
-        NR1 : TYPE
-             A number ranging from 0 through 255. The binary bits the
-             questionable PTR register are set according to this value.
-        """
-        if int(NR1) in range(256):
-            self.inst.write(f"STAT:QUES:PTR {NR1}")
-        else:
-            raise ValueError("Value Error. Please enter an integer between 0 "
-                             "and 255.")
+        addresses : list, optional
+            Addresses to probe. The default is None, which probes every
+            resource the resource manager lists.
+
+        Returns
+        -------
+        dict
+            Entries of the power supplies found by this scan, by serial
+            number.
+        """
+        if addresses is None:
+            addresses = KEI2220S.resource_manager().list_resources()
+        found = {}
+        with ThreadPoolExecutor(max(1, min(self.workers,
+                                           len(addresses)))) as pool:
+            for entry in pool.map(self.probe, addresses):
+                if entry is not None:
+                    found[entry['idn'][2]] = entry
+        probed = set(addresses)
+        self.entries = {serial: entry for serial, entry in
+                        self.entries.items()
+                        if entry['address'] not in probed or
+                        serial in found}
+        self.entries.update(found)
+        self.save()
+        return(found)
     
-    def get_ptr(self):
-        """
-        Returns the positive transition filter of the questionable event
-        register.
-        """
-        ptr= str(self.inst.query("STAT:QUES:PTR?"))
-        return(ptr)
+    def forget(self, serial):
+        """Removes the entry of a serial number and saves the cache."""
+        if self.entries.pop(serial, None) is not None:
+            self.save()
+
+
+class LatencyModel():
+    """
+    Estimate of the time a SCPI exchange takes: the bytes on the wire at the
+    baud rate, a fixed turnaround per exchange and a processing time per
+    command.
+    """
     
-    def get_sbr(self):
+    def __init__(self, baud_rate = 9600, turnaround = 0.01,
+                 per_command = 0.002, reply_bytes = 12):
+        """
+        Parameters
+        ----------
+        baud_rate : int, optional
+            Baud rate of the link, or None for links where the wire time is
+            negligible, such as USB. The default is 9600.
+        turnaround : float, optional
+            Fixed time per exchange in seconds. The default is 0.01.
+        per_command : float, optional
+            Instrument processing time per command in seconds. The default is
+            0.002.
+        reply_bytes : int, optional
+            Typical length of the reply to one query. The default is 12.
+        """
+        self.baud_rate = baud_rate
+        self.turnaround = turnaround
+        self.per_command = per_command
+        self.reply_bytes = reply_bytes
+        
+    def exchange(self, message, queries = 0):
         """
-        Returns the contents of the status byte register (SBR) using the Master
-        Summary Status (MSS) bit.
+        Returns the estimated time in seconds of sending one message and,
+        if it holds queries, reading their replies.
         """
-        sbr = str(self.inst.query("*SRE?"))
-        return(sbr)
+        commands = message.count(';') + 1
+        seconds = self.turnaround + commands * self.per_command
+        if self.baud_rate:
+            size = len(message) + 1 + queries * (self.reply_bytes + 1)
+            seconds += size * 10 / self.baud_rate
+        return(seconds)
     
-    def get_error(self):
+    def calibrate(self, psu, count = 10):
         """
-        Queries the error code and error information of the power supply and
-        returns both values.
+        Sets the turnaround from the mean round trip of *OPC? on a session.
         """
-        error = str(self.inst.query("SYST:ERR?"))
-        return(error)
+        start = time.perf_counter()
+        for _ in range(count):
+            psu.inst.query("*OPC?")
+        mean = (time.perf_counter() - start) / count
+        self.turnaround = max(0.0, mean - self.exchange("*OPC?", 1) +
+                              self.turnaround)
+        return(self)
+
+
+class TestPlan():
+    """
+    Records driver operations and runs them as few SCPI exchanges as
+    possible. Every driver command of the command table can be called on
+    the plan; its arguments are validated and encoded when it is recorded.
+    The plan is divided into phases by pause and phase. Each phase is sent
+    as one compound message and read back as one reply, which is the only
+    sync point of the phase; a phase without queries ends with *OPC?.
+    Operations keep their recorded order, so every operation sees the
+    state the operations before it set.
+    """
     
-    def key(self, NR1):
+    def __init__(self, psu, latency = None):
         """
-        This command can produce the same effect as pressing one of the
-        front-panel buttons. The instrument must be in local mode in order for
-        fthis command to simulate a front-panel button press.
+        Parameters
+        ----------
+        psu : KEI2220S
+            Session the plan runs on.
+        latency : LatencyModel, optional
+            Model used by estimate. The default is None, which uses a
+            LatencyModel for the baud rate of the session.
+        """
+        self.psu = psu
+        if latency is None:
+            address = str(getattr(psu, 'inst_address', 'ASRL')).upper()
+            latency = LatencyModel(getattr(psu, 'baud_rate', 9600)
+                                   if address.startswith('ASRL') else None)
+        self.latency = latency
+        self.phases = [[]]
+        self.pauses = [0.0]
+        
+    def __getattr__(self, name):
+        command = self.psu.commands.get(name)
+        if command is None:
+            raise AttributeError(name)
+        
+        def record(*args, **kwargs):
+            message = command.encode(self.psu, *args, **kwargs)
+            self.phases[-1].append((message, command))
+            return(self)
+        record.__doc__ = command.doc
+        return(record)
+    
+    def phase(self):
+        """Ends the current phase."""
+        if self.phases[-1]:
+            self.phases.append([])
+            self.pauses.append(0.0)
+        return(self)
+    
+    def pause(self, seconds):
+        """Waits for a time after the current phase, then starts a new one."""
+        self.pauses[-1] += seconds
+        self.phases.append([])
+        self.pauses.append(0.0)
+        return(self)
+    
+    def compile(self):
+        """
+        Returns the compiled plan as a list of (message, parsers, pause)
+        tuples, one per phase, where parsers holds the name and parser of
+        each query in the message. A write is only left out when the write
+        right after it sets the same parameter; any other operation between
+        two writes of a setting keeps both, so a plan such as set_volt(0),
+        set_output_state(1), set_volt(12) still turns the output on at 0 V.
+        """
+        compiled = []
+        for operations, pause in zip(self.phases, self.pauses):
+            messages = []
+            parsers = []
+            writes = []
+            for message, command in operations:
+                if command.query:
+                    messages.extend(_merge_writes(writes))
+                    writes = []
+                    messages.append(message)
+                    parsers.append((command.name, command.parser))
+                else:
+                    writes.append(message)
+            messages.extend(_merge_writes(writes))
+            if messages and not parsers:
+                messages.append("*OPC?")
+            if messages or pause:
+                compiled.append((_join(messages), parsers, pause))
+        return(compiled)
+    
+    def estimate(self):
+        """Returns the estimated duration of the plan in seconds."""
+        seconds = 0.0
+        for message, parsers, pause in self.compile():
+            if message:
+                seconds += self.latency.exchange(message,
+                                                 max(1, len(parsers)))
+            seconds += pause
+        return(seconds)
+    
+    def run(self):
+        """
+        Runs the plan and returns the replies of its queries as a list of
+        (name, value) pairs, in order.
+        """
+        results = []
+        query = self.psu.inst.query
+        for message, parsers, pause in self.compile():
+            if message:
+                replies = str(query(message)).split(';')
+                for (name, parser), reply in zip(parsers, replies):
+                    results.append((name, parser(reply)))
+            if pause:
+                time.sleep(pause)
+        return(results)
 
+
+class Regulator():
+    """
+    Host-side regulation of a quantity the supply cannot regulate itself:
+    constant output power, constant output resistance (V/I), or an external
+    feedback value such as a voltage measured at a remote point. Each
+    iteration is one exchange that writes the new voltage and reads back the
+    last measured voltage and current. The instrument only measures about
+    every 100 ms, so iterations are paced to sample_period to act on a new
+    sample each time. The voltage is kept within the model limit and below
+    the OVP level, both read once when the regulator starts, and changes by
+    at most max_slew per iteration. While the regulated quantity cannot be
+    measured, for example V/I with no current flowing, the loop holds the
+    voltage, or ramps it up to start_volt if one is given, and stops after
+    max_unmeasured such iterations in a row.
+    """
+    
+    def __init__(self, psu, mode, setpoint, feedback = None, kp = None,
+                 ki = None, kd = 0.0, ovp_margin = 0.98, max_slew = 0.5,
+                 feedforward = 0.25, start_volt = None, max_unmeasured = 50,
+                 sample_period = 0.1):
+        """
         Parameters
         ----------
-        NR1 : int
-            Integer key code.
+        psu : KEI2220S
+            Session of the power supply.
+        mode : str
+            'power' for constant power in W, 'resistance' for constant V/I in
+            ohms, or 'pid' for an external feedback value.
+        setpoint : float
+            Target value of the regulated quantity.
+        feedback : callable, optional
+            Function returning the regulated quantity, required in 'pid'
+            mode. The default is None.
+        kp, ki, kd : float, optional
+            Proportional, integral and derivative gains in V per unit of
+            error. The defaults depend on the mode.
+        ovp_margin : float, optional
+            Fraction of the OVP level the voltage may reach. The default is
+            0.98.
+        max_slew : float, optional
+            Largest change of the voltage in one iteration, in V. The default
+            is 0.5.
+        feedforward : float, optional
+            Fraction of the way the power mode moves towards the voltage a
+            resistive load would need, estimated from the last sample. The
+            default is 0.25; 0 disables the feedforward.
+        start_volt : float, optional
+            Voltage the loop ramps up to while the regulated quantity cannot
+            be measured. The default is None, which holds the voltage.
+        max_unmeasured : int, optional
+            Number of iterations in a row without a measurable quantity after
+            which the loop stops. The default is 50.
+        sample_period : float, optional
+            Shortest time between iterations in seconds. The default is 0.1,
+            the measurement period of the instrument.
+        """
+        if mode not in ['power', 'resistance', 'pid']:
+            raise ValueError("Value Error. Please enter power, resistance, "
+                             "or pid.")
+        if mode == 'pid' and feedback is None:
+            raise ValueError("Value Error. The pid mode needs a feedback "
+                             "function.")
+        self.psu = psu
+        self.mode = mode
+        self.setpoint = setpoint
+        self.feedback = feedback
+        self.kp = (0.0 if mode == 'power' else 0.5) if kp is None else kp
+        self.ki = (2.0 if mode == 'power' else 5.0) if ki is None else ki
+        self.kd = kd
+        self.ovp_margin = ovp_margin
+        self.max_slew = max_slew
+        self.feedforward = feedforward
+        self.start_volt = start_volt
+        self.max_unmeasured = max_unmeasured
+        self.sample_period = sample_period
+        self._stopped = threading.Event()
+        
+    def _max_volt(self):
+        """Returns the highest voltage the regulator may set."""
+        max_volt = self.psu.get_limits()[0]
+        try:
+            if str(self.psu.get_ovp_state()).strip().upper() in ['1', 'ON']:
+                max_volt = min(max_volt,
+                               float(self.psu.get_ovp()) * self.ovp_margin)
+        except ValueError:
+            pass
+        return(max_volt)
+    
+    def _measure(self, volt, curr):
+        """
+        Returns the regulated quantity, or None when it cannot be measured.
         """
-        if int(NR1) in range(1, 23) or int(NR1) == 64:
-            self.inst.write(f"SYST:KEY {NR1}")
+        if self.mode == 'power':
+            value = volt * curr
+        elif self.mode == 'resistance':
+            if curr <= 1e-9:
+                return(None)
+            value = volt / curr
         else:
-            raise ValueError("Value Error. Please enter an integer between 1 "
-                             "and 22,or 64.")
-            
-    def syst_local(self):
-        """Sets the power supply for control from the frontpanel."""
-        self.inst.write("SYS:LOC")
+            value = float(self.feedback())
+        if value != value or abs(value) == float('inf'):
+            return(None)
+        return(value)
+    
+    def stop(self):
+        """Stops a running regulation loop from another thread."""
+        self._stopped.set()
         
-    def syst_pos(self, string):
+    def run(self, duration = None, iterations = None):
         """
-         Determines how the power supply initializes when its power switch is
-         turned on. This command configures the instrument to power up with
-         default settings, or power up with the settings that were in effect
-         when the instrument was turned off.
+        Runs the regulation loop.
 
         Parameters
         ----------
-        string : str
-            Initialization of the power setting.
+        duration : float, optional
+            Length of the run in seconds.
+        iterations : int, optional
+            Number of loop iterations. At least one of duration and
+            iterations must be given, unless the loop is ended with stop.
+
+        Returns
+        -------
+        dict
+            Loop rate, number of iterations, number of iterations in which
+            the quantity could be measured and regulated, RMS and maximum
+            tracking error over those iterations (None if there were none),
+            whether the loop was regulating at the end, and the last voltage
+            set. The loop was not regulating at the end if it stopped after
+            max_unmeasured iterations without a measurable quantity.
+        """
+        max_volt = self._max_volt()
+        query = self.psu.inst.query
+        clock = time.perf_counter
+        output = float(self.psu.get_voltage())
+        volt, curr = (float(value) for value in
+                      query("FETC:VOLT?;:FETC:CURR?").split(';'))
+        integral = 0.0
+        last_error = None
+        count = 0
+        regulated = 0
+        unmeasured = 0
+        squared = 0.0
+        worst = 0.0
+        regulating = False
+        self._stopped.clear()
+        start = last = clock()
+        end = start + duration if duration is not None else float('inf')
+        while not self._stopped.is_set():
+            if iterations is not None and count >= iterations:
+                break
+            # Wait for the next measurement instead of acting again on the
+            # one the last exchange read back.
+            if count and self._stopped.wait(
+                    max(0.0, last + self.sample_period - clock())):
+                break
+            now = clock()
+            if now >= end:
+                break
+            # dt is the measured loop period, so the integral and derivative
+            # terms follow the real latency of the link.
+            dt = now - last
+            last = now
+            measured = self._measure(volt, curr)
+            regulating = measured is not None
+            if regulating:
+                unmeasured = 0
+                error = self.setpoint - measured
+                base = output
+                if self.mode == 'power' and curr > 1e-9 and volt > 0:
+                    # One sample of V/I is a poor estimate of a nonlinear
+                    # load, so only move part of the way towards it.
+                    target = min((self.setpoint * volt / curr) ** 0.5,
+                                 max_volt)
+                    base += self.feedforward * (target - output)
+                derivative = ((error - last_error) / dt
+                              if last_error is not None and dt > 0 else 0.0)
+                candidate = (base + self.kp * error + self.ki * (integral +
+                             error * dt) + self.kd * derivative)
+                last_error = error
+                regulated += 1
+                squared += error * error
+                worst = max(worst, abs(error))
+            else:
+                unmeasured += 1
+                if unmeasured > self.max_unmeasured:
+                    break
+                # Nothing to regulate on: hold the output, or ramp it up to
+                # the start voltage.
+                candidate = (output if self.start_volt is None
+                             else max(output, self.start_volt))
+                last_error = None
+            limited = min(max(candidate, output - self.max_slew,
+                              0.0), output + self.max_slew, max_volt)
+            if regulating and limited == candidate:
+                integral += error * dt
+            output = limited
+            reply = query(f"VOLT {output:.4f};:FETC:VOLT?;:FETC:CURR?")
+            volt, curr = (float(value) for value in reply.split(';'))
+            count += 1
+        elapsed = clock() - start
+        return({'iterations': count,
+                'regulated_iterations': regulated,
+                'loop_rate_hz': count / elapsed if elapsed > 0 else None,
+                'rms_error': ((squared / regulated) ** 0.5 if regulated
+                              else None),
+                'max_error': worst if regulated else None,
+                'regulating': regulating,
+                'volt': output})
+
+
+class ReadCache():
+    """
+    Opt-in cache of the last measured voltage, current and power. The
+    instrument updates these about every 100 ms, so a read within the
+    maximum age of a quantity is answered from memory. When any requested
+    quantity is stale, all of them are fetched again in one exchange.
+    """
+    
+    queries = {'volt': "FETC:VOLT?", 'curr': "FETC:CURR?",
+               'power': "FETC:POW?"}
+    
+    def __init__(self, psu, max_age = None):
         """
-        if str(string).upper() in ['RST', 'RCL0']:
-            self.inst.write(f"SYST:POS {string}.upper()")
+        Parameters
+        ----------
+        psu : KEI2220S
+            Session of the power supply.
+        max_age : dict, optional
+            Maximum age in seconds by quantity. The default is None, which
+            uses 0.1 s for every quantity.
+        """
+        self.psu = psu
+        self.max_age = dict.fromkeys(self.queries, 0.1)
+        if max_age is not None:
+            unknown = set(max_age) - set(self.queries)
+            if unknown:
+                raise ValueError("Value Error. Please enter volt, curr, or "
+                                 "power.")
+            self.max_age.update(max_age)
+        self.message = _join(list(self.queries.values()))
+        self.replies = {}
+        self.time = None
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.refreshes = 0
+        
+    def refresh(self):
+        """Fetches every quantity in one exchange."""
+        with self.lock:
+            replies = str(self.psu.inst.query(self.message)).split(';')
+            self.time = time.monotonic()
+            self.replies = dict(zip(self.queries, replies))
+            self.refreshes += 1
+            
+    def age(self):
+        """Returns the age of the cached values in seconds."""
+        if self.time is None:
+            return(float('inf'))
+        return(time.monotonic() - self.time)
+    
+    def reply(self, quantity):
+        """Returns the reply for a quantity, refreshing it if stale."""
+        if self.age() > self.max_age[quantity]:
+            self.refresh()
         else:
-            raise ValueError("Value Error. Please enter either RST or RCL0.")
+            self.hits += 1
+        return(self.replies[quantity])
     
-    def get_syst_pos(self):
-        """Returns the initilization setting of the power supply."""
-        pos = str(self.inst.query("SYST:POS?"))
-        return(pos)
+    def read(self, quantity):
+        """
+        Returns a quantity and how old it is.
+
+        Parameters
+        ----------
+        quantity : str
+            'volt', 'curr' or 'power'.
+
+        Returns
+        -------
+        tuple
+            (value, age in seconds).
+        """
+        if quantity not in self.queries:
+            raise ValueError("Value Error. Please enter volt, curr, or "
+                             "power.")
+        value = float(self.reply(quantity))
+        return(value, self.age())
+
+
+# Named bits of the questionable and operation status registers.
+_QUESTIONABLE_EVENTS = {0: 'OVP', 1: 'OCP', 4: 'OTP', 5: 'RI'}
+_OPERATION_EVENTS = {0: 'CAL', 1: 'CV', 2: 'CC', 3: 'TIMER_DONE',
+                     4: 'LIST_DONE', 5: 'WTG'}
+
+
+class StatusRecorder():
+    """
+    Timeline of status events. The questionable transition filters are set
+    so the instrument latches both edges of the watched bits in the
+    questionable event register, and the operation event register latches
+    its bits as they are set. Both event registers are read together with
+    the condition registers in one exchange at a low rate, so short events
+    are caught without polling the conditions quickly. Events are kept in
+    two compact arrays of times and codes.
+    """
     
-    def syst_remote(self):
-        """Sets the power supply to remote control mode."""
-        self.inst.write("SYST:REM")
-        
-    def syst_lock(self):
+    registers = (('QUES', _QUESTIONABLE_EVENTS),
+                 ('OPER', _OPERATION_EVENTS))
+    
+    def __init__(self, psu):
         """
-        If the power supply is in remote mode, this command locks out the
-        front panel LOCAL button. This command has no effect if the
-        instrument is in local mode.
+        Parameters
+        ----------
+        psu : KEI2220S
+            Session of the power supply.
         """
-        self.inst.write("SYST:RWL")
+        self.psu = psu
+        self.times = array.array('d')
+        self.codes = array.array('H')
+        self._thread = None
         
-    def get_syst_version(self):
-        """Returns SCPI version of the instrument."""
-        scpi = str(self.inst.query("SYST:VER?"))
-        return(scpi)
-    
-    def trigger(self):
-        """Generates a trigger event."""
-        self.inst.write("*TRG")
+    def configure(self):
+        """
+        Sets the questionable transition filters to latch both edges of the
+        named bits and clears the event registers.
+        """
+        mask = sum(1 << bit for bit in _QUESTIONABLE_EVENTS)
+        self.psu.set_ptr(mask)
+        self.psu.set_ntr(mask)
+        self.psu.inst.query("STAT:QUES?;:STAT:OPER:EVEN?")
         
-    def force_trigger(self):
-        """Forces an immediate trigger event."""
-        self.inst.write("TRIG")
+    def poll(self):
+        """
+        Reads the event and condition registers in one exchange and appends
+        the events found. Returns the number of new events.
+        """
+        reply = str(self.psu.inst.query("STAT:QUES?;:STAT:OPER:EVEN?;"
+                                        ":STAT:QUES:COND?;"
+                                        ":STAT:OPER:COND?")).split(';')
+        stamp = time.time()
+        events = [int(float(value)) for value in reply[:2]]
+        conditions = [int(float(value)) for value in reply[2:4]]
+        count = 0
+        for register, (_, names) in enumerate(self.registers):
+            for bit in names:
+                if (events[register] >> bit) & 1:
+                    level = (conditions[register] >> bit) & 1
+                    self.times.append(stamp)
+                    self.codes.append(register << 8 | bit << 1 | level)
+                    count += 1
+        return(count)
+    
+    def start(self, interval = 0.25):
+        """
+        Configures the filters and starts a thread polling every interval
+        seconds.
+        """
+        self.stop()
+        self.configure()
+        stopped = threading.Event()
+        thread = threading.Thread(target=self._run, args=(interval, stopped),
+                                  daemon=True, name='KEI2220S status')
+        self._thread = (thread, stopped)
+        thread.start()
         
-    def trigger_source(self, string):
+    def stop(self):
+        """Stops the polling thread."""
+        if self._thread is not None:
+            thread, stopped = self._thread
+            stopped.set()
+            thread.join()
+            self._thread = None
+            
+    def _run(self, interval, stopped):
+        while not stopped.wait(interval):
+            try:
+                self.poll()
+            except (visa.VisaIOError, OSError, ValueError):
+                pass
+            
+    def __len__(self):
+        return(len(self.codes))
+    
+    def events(self):
         """
-        Sets the source of trigger events.
+        Returns the timeline as a list of (time, event, level) tuples, where
+        time is in seconds since the epoch, event is the name of the bit and
+        level is 1 if the condition was present when it was read.
+        """
+        timeline = []
+        for stamp, code in zip(self.times, self.codes):
+            register, names = self.registers[code >> 8]
+            timeline.append((stamp, names[(code >> 1) & 0x7f], code & 1))
+        return(timeline)
+
 
+class Job():
+    """
+    Test of one DUT: the voltage and current it needs and the function that
+    runs it. The function is called as run(psu, job) with the session it
+    was assigned to, and should return when job.cancelled is set. On a
+    multi-output model job.channel is the number of the output that covers
+    the job, and the function should act on psu.ch[job.channel]; on other
+    models it is None.
+    """
+    
+    def __init__(self, name, volt, curr, run, priority = 0):
+        """
         Parameters
         ----------
-        string : str
-            Source of trigger event.
-        """
-        if str(string).upper() in ['MAN', 'IMM', 'EXT', 'BUS']:
-            self.inst.write(f"TRIG:SOUR {string}.upper()")
-        else:
-            raise ValueError("Value Error. Please enter MAN, IMM, EXT, or BUS")
-            
-    def get_trigger_source(self):
-        """Returns the source of the trigger event."""
-        trig_event = str(self.inst.query("TRIG:SOUR?"))
-        return(trig_event)
+        name : str
+            Name of the job.
+        volt : float
+            Highest voltage the job sets, in V.
+        curr : float
+            Highest current the job sets, in A.
+        run : callable
+            Function running the test.
+        priority : int, optional
+            Jobs with lower numbers run first. The default is 0.
+        """
+        self.name = name
+        self.volt = volt
+        self.curr = curr
+        self.run = run
+        self.priority = priority
+        self.cancelled = threading.Event()
+        self.supply = None
+        self.channel = None
+        self.result = None
+        self.error = None
+        self.start_time = None
+        self.end_time = None
+        
+    def output(self, psu):
+        """
+        Returns the number of the first output of a multi-output session
+        that covers both the voltage and the current of the job, 0 if the
+        model has a single output that covers them, or None if no output
+        does.
+        """
+        outputs = _CHANNELS.get(psu.get_model())
+        if outputs is None:
+            max_volt, max_curr = psu.get_limits()
+            return(0 if self.volt <= max_volt and self.curr <= max_curr
+                   else None)
+        for number, (max_volt, max_curr) in enumerate(outputs, 1):
+            if self.volt <= max_volt and self.curr <= max_curr:
+                return(number)
+        return(None)
     
-    def get_test(self):
-        """Initiates a self-test and reports any errors."""
-        test = str(self.inst.query("*TST?"))
-        return(test)
+    def fits(self, psu):
+        """Returns True if the model of a session can supply the job."""
+        return(self.output(psu) is not None)
+
+
+class JobScheduler():
+    """
+    Runs a queue of DUT jobs concurrently across power supplies. Each job
+    goes to a supply whose model limits cover its voltage and current. A
+    free supply takes the queued job with the lowest priority number that
+    it can run; among equal priorities it takes the job that the fewest
+    supplies can run, so scarce large supplies are kept for the jobs that
+    need them. On a multi-output model the job is given the number of the
+    output that covers it. Every output of a supply is turned off after
+    every job, including failed and cancelled ones, before it takes the
+    next.
+    """
     
-    def wait(self):
+    def __init__(self, sessions):
         """
-        Prevents the instrument from executing further
-        commands or queries until all pending commands are complete.
+        Parameters
+        ----------
+        sessions : list
+            KEI2220S sessions to run the jobs on.
+        """
+        self.sessions = list(sessions)
+        self.pending = []
+        self.done = []
+        self.running = {}
+        self.condition = threading.Condition()
+        self._order = itertools.count()
+        self._stopped = False
+        self._reset_stats()
+        
+    def _reset_stats(self):
+        """Clears the per-supply statistics."""
+        self.stats = {index: {'model': psu.get_model(), 'jobs': 0,
+                              'failures': 0, 'busy_s': 0.0}
+                      for index, psu in enumerate(self.sessions)}
+        
+    def submit(self, job):
+        """Queues a job. Raises ValueError if no supply can run it."""
+        capable = [index for index, psu in enumerate(self.sessions)
+                   if job.fits(psu)]
+        if not capable:
+            raise ValueError(f"Value Error. No supply can provide {job.volt} "
+                             f"V and {job.curr} A for {job.name}.")
+        with self.condition:
+            self.pending.append((job.priority, len(capable),
+                                 next(self._order), job, frozenset(capable)))
+            self.condition.notify_all()
+        return(job)
+    
+    def stop(self):
+        """
+        Stops taking queued jobs and cancels the running ones. Their outputs
+        are turned off as they return.
         """
-        self.inst.write("*WAI")
\ No newline at end of file
+        with self.condition:
+            self._stopped = True
+            for job in self.running.values():
+                job.cancelled.set()
+            self.condition.notify_all()
+            
+    def _take(self, index):
+        """Returns the next job for a supply, or None when there is none."""
+        with self.condition:
+            while True:
+                if self._stopped:
+                    return(None)
+                entries = [entry for entry in self.pending
+                           if index in entry[4]]
+                if entries:
+                    entry = min(entries, key=lambda entry: entry[:3])
+                    self.pending.remove(entry)
+                    self.running[index] = entry[3]
+                    return(entry[3])
+                if not self.pending:
+                    return(None)
+                self.condition.wait()
+                
+    def _serve(self, index):
+        psu = self.sessions[index]
+        stats = self.stats[index]
+        while True:
+            job = self._take(index)
+            if job is None:
+                break
+            job.supply = index
+            job.channel = job.output(psu) or None
+            outputs = [psu] if job.channel is None else psu.ch.values()
+            job.start_time = time.perf_counter()
+            try:
+                job.result = job.run(psu, job)
+            except Exception as error:
+                job.error = error
+            finally:
+                for output in outputs:
+                    try:
+                        output.set_output_state(0)
+                    except Exception as error:
+                        if job.error is None:
+                            job.error = error
+                job.end_time = time.perf_counter()
+            with self.condition:
+                del self.running[index]
+                self.done.append(job)
+                stats['jobs'] += 1
+                stats['failures'] += job.error is not None
+                stats['busy_s'] += job.end_time - job.start_time
+                self.condition.notify_all()
+                
+    def run(self):
+        """
+        Runs the queued jobs and returns when they are all done or the
+        scheduler is stopped.
+
+        Returns
+        -------
+        dict
+            Elapsed time, and per supply the jobs run, failures, busy time,
+            utilization and throughput in jobs per hour, all for this run.
+        """
+        self._stopped = False
+        self._reset_stats()
+        start = time.perf_counter()
+        threads = [threading.Thread(target=self._serve, args=(index,),
+                                    daemon=True,
+                                    name=f"KEI2220S scheduler {index}")
+                   for index in range(len(self.sessions))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        supplies = {}
+        for index, stats in self.stats.items():
+            supplies[index] = dict(stats)
+            supplies[index]['utilization'] = (stats['busy_s'] / elapsed
+                                              if elapsed > 0 else 0.0)
+            supplies[index]['jobs_per_hour'] = (stats['jobs'] * 3600 /
+                                                elapsed if elapsed > 0
+                                                else 0.0)
+        return({'elapsed_s': elapsed, 'supplies': supplies})
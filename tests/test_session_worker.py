@@ -0,0 +1,61 @@
+import importlib.util
+import os
+import threading
+
+import pytest
+
+pytest.importorskip('pyvisa')
+
+_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                     '2220 Programmable DC Power Supplies.py')
+_SPEC = importlib.util.spec_from_file_location('kei2220s', _PATH)
+kei2220s = importlib.util.module_from_spec(_SPEC)
+_SPEC.loader.exec_module(kei2220s)
+
+
+class SlowTransport():
+    """Transport whose queries block until released."""
+    
+    def __init__(self):
+        self.sent = []
+        self.busy = threading.Event()
+        self.release = threading.Event()
+        
+    def write(self, message):
+        self.sent.append(message)
+        return(len(message))
+    
+    def query(self, message):
+        self.busy.set()
+        self.release.wait(5)
+        self.sent.append(message)
+        return('0')
+    
+    def close(self):
+        pass
+
+
+def output_state(sent):
+    """Returns the output state left by the messages sent to the bus."""
+    state = None
+    for message in sent:
+        for part in message.split(';'):
+            part = part.lstrip(':').upper()
+            if part.startswith('OUTP '):
+                state = part[5:].strip() in ('1', 'ON')
+    return(state)
+
+
+def test_output_off_is_not_overtaken_by_earlier_writes():
+    transport = SlowTransport()
+    worker = kei2220s.SessionWorker(transport)
+    worker.query('MEAS:VOLT?')
+    assert transport.busy.wait(5)
+    output_on = worker.write('OUTP 1')
+    output_off = worker.write('OUTP 0')
+    transport.release.set()
+    output_off.result(5)
+    worker.stop()
+    with pytest.raises(RuntimeError):
+        output_on.result(5)
+    assert output_state(transport.sent) is False